@@ -30,7 +30,8 @@
               Once the player is out of lives, they will be presented with a
               high score entry box, where the player inputs their name.
               On completion, the current score will be written to the
-              local score_file.txt, from which the top 10 high scores will then
+              leaderboard, the local score_file.txt unless a leaderboard
+              server is given, from which the top 10 high scores will then
               be loaded. The game is designed so that the difficulty will
               increase by default, as more obstacles are destroyed, there is a
               chance for more enemy spaceships to spawn.
@@ -45,11 +46,21 @@
 
 
 '''
+import argparse
 import pygame
 import random
+import time
 
+from collections import deque
 from os import path
 
+from atlas import Atlas, AtlasGroup
+from controls import Controls
+from leaderboard import LocalBackend, RemoteBackend, server_url
+from parallax import Parallax, OpaqueLayer, StarLayer
+import spatial
+import telemetry
+
 img_dir = path.join(path.dirname(__file__), 'img')
 snd_dir = path.join(path.dirname(__file__), 'snd')
 
@@ -70,8 +81,26 @@ SCREEN_HEIGHT = 600
 DIFFICULTY = 15
 POWERUP_TIME = 4000
 
+# Shots per second while fire is held down
+FIRE_RATE = 6
+
+# Most obstacles spawned in one frame, the rest wait their turn
+SPAWN_BUDGET = 2
+
+# How the game gets harder as the score goes up, as (score, value) points.
+# Values are interpolated between points and held after the last one.
+DIFFICULTY_CURVES = {
+    # Chance that a destroyed obstacle is replaced by an enemy ship
+    'enemy_chance': [(0, 0.2), (25, 1 / 3), (75, 0.5), (200, 0.6)],
+    # Chance that a destroyed obstacle drops a powerup
+    'powerup_chance': [(0, 0.1), (100, 0.1), (200, 0.05)],
+}
+
 FPS = 60
 
+# Size of the world played with --world, eight screens across
+WORLD_SIZE = (SCREEN_WIDTH * 8, SCREEN_HEIGHT)
+
 # Load all game graphics
 background = pygame.image.load(path.join(img_dir, 'spacefield_a-000.png'))
 background = pygame.transform.scale(background, (SCREEN_WIDTH, SCREEN_HEIGHT))
@@ -91,11 +120,55 @@ powerup_gun_img = pygame.image.load(path.join(img_dir, 'bolt_gold.png'))
 explosion_anim = []
 spaceship_explosion = []
 
+# Sounds are shared between sprites, loaded on first use by load_sound
+sounds = {}
+
+# Sprite images packed onto shared sheets, filled in by load_atlas
+atlas = Atlas()
+rotation_sources = {}
+
+# Scrolling background behind the game, filled in by load_parallax
+parallax = Parallax()
+
+# Area the sprites move in, the screen unless playing on a larger world
+playfield = pygame.Rect(0, 0, SCREEN_WIDTH, SCREEN_HEIGHT)
+
+# Random numbers that drive the game, seeded so that netplay peers spawn the
+# same obstacles and powerups
+rng = random.Random()
+
+# Game time in milliseconds, netplay swaps it for a clock that advances a
+# fixed step every tick so that both peers see the same times
+get_ticks = pygame.time.get_ticks
+
+# Session telemetry, a telemetry.Recorder while one is being recorded
+recorder = None
+
+# Video capture, a video.VideoCapture while the game is being captured
+video_capture = None
+
+# Where high scores are kept, the local score file unless main is given a
+# leaderboard server
+leaderboard = LocalBackend("score_file.txt")
+
 # Define fpnt type for score
 font_name = pygame.font.match_font('Calibri')
 
 
 # --- Classes ---
+class HeldKeys(object):
+    """ Stands in for pygame.key.get_pressed, for a spaceship steered by
+        something other than the keyboard, which fills in the keys held. """
+    def __init__(self):
+        self.held = set()
+
+    def __call__(self):
+        return self
+
+    def __getitem__(self, key):
+        return key in self.held
+
+
 class Vehicle(pygame.sprite.Sprite):
     """ This class represents a vehicle. """
     def __init__(self, x_position, y_position):
@@ -108,20 +181,15 @@ class Spaceship(Vehicle):
     width = 50
     height = 38
 
-    def __init__(self):
-        super().__init__(SCREEN_WIDTH / 2,
-                         SCREEN_HEIGHT - Spaceship.height - 30)
+    def __init__(self, x_position=SCREEN_WIDTH / 2):
+        super().__init__(x_position,
+                         playfield.height - Spaceship.height - 30)
         self.lives = 3
         self.hidden = False
-        self.hide_timer = pygame.time.get_ticks()
-        self.orig_image = pygame.transform.scale(spaceship_img,
-                                                 (Spaceship.width,
-                                                  Spaceship.height))
-        self.dmg_image = pygame.transform.scale(spaceship_dmg,
-                                                (Spaceship.width,
-                                                 Spaceship.height))
+        self.hide_timer = get_ticks()
+        self.orig_image = atlas.image('player')
+        self.dmg_image = atlas.image('player_damaged')
         self.image = self.orig_image
-        self.image.set_colorkey(BLACK)
         self.rect = self.image.get_rect()
         self.radius = 20
 #       pygame.draw.circle(self.image, RED, self.rect.center, self.radius)
@@ -129,11 +197,16 @@ class Spaceship(Vehicle):
         self.rect.y = self.position[1]
         self.x_speed = 0
         self.health = 100
-        self.shoot_sound = pygame.mixer.Sound(path.join(snd_dir, 'laser5.wav'))
+        self.shoot_sound = load_sound('laser5.wav')
         self.power = 1
-        self.power_time = pygame.time.get_ticks()
-        self.expl_sound = pygame.mixer.Sound(path.join(snd_dir,
-                                                       'explosion.wav'))
+        self.power_time = get_ticks()
+        self.fire_rate = FIRE_RATE
+        self.shot_time = get_ticks()
+        self.expl_sound = load_sound('explosion.wav')
+        self.death_explosion = None
+        # Source of the held key state, a HeldKeys when the spaceship is
+        # not steered straight from the keyboard
+        self.key_state = pygame.key.get_pressed
 
     def update(self):
         """ Update the spaceship location. """
@@ -141,39 +214,41 @@ class Spaceship(Vehicle):
         self.x_speed = 0
 
         # Check for left or right key presses, and adjust x_speed accordingly
-        if pygame.key.get_pressed()[pygame.K_LEFT]:
+        keys = self.key_state()
+        if keys[pygame.K_LEFT]:
             self.x_speed = -9
-        if pygame.key.get_pressed()[pygame.K_RIGHT]:
+        if keys[pygame.K_RIGHT]:
             self.x_speed = 9
         self.rect.x += self.x_speed
 
         # Make sure spaceship does not go off screen
-        if self.rect.x + 50 > SCREEN_WIDTH:
-            self.rect.x = SCREEN_WIDTH - Spaceship.width
+        if self.rect.x + 50 > playfield.width:
+            self.rect.x = playfield.width - Spaceship.width
         if self.rect.x < 0:
             self.rect.x = 0
 
         # If health is below a certain amount, show damaged spaceship
         if self.health <= 50:
-            self.image = self.dmg_image.copy()
+            self.image = self.dmg_image
         else:
-            self.image = self.orig_image.copy()
+            self.image = self.orig_image
 
         # Check hide timer, if hidden for more than 1 second, reshow ship
         # at correct location
-        if self.hidden and pygame.time.get_ticks() - self.hide_timer > 1000:
+        if self.hidden and get_ticks() - self.hide_timer > 1000:
             self.hidden = False
-            self.rect.x = SCREEN_WIDTH / 2
-            self.rect.y = SCREEN_HEIGHT - Spaceship.height - 30
+            self.rect.x = self.position[0]
+            self.rect.y = self.position[1]
 
         # Check for if powerup is active
-        if self.power >= 2 and
-        pygame.time.get_ticks() - self.power_time > POWERUP_TIME:
+        if self.power >= 2 and \
+           get_ticks() - self.power_time > POWERUP_TIME:
             self.power -= 1
-            self.power_time = pygame.time.get_ticks()
+            self.power_time = get_ticks()
 
     def shoot(self, all_sprites_list, bullet_list):
         """ Shoot bullet taking into account any powerups"""
+        self.shot_time = get_ticks()
         # Check current powerup status
         if self.power == 1:
             bullet = Bullet(self.rect.x +
@@ -193,17 +268,22 @@ class Spaceship(Vehicle):
             bullet_list.add(bullet1)
             bullet_list.add(bullet2)
 
+    def reloaded(self):
+        """ Whether enough time has gone by since the last shot to fire
+            again while fire is held. """
+        return get_ticks() - self.shot_time >= 1000 / self.fire_rate
+
     def hide(self):
         """ Hide the spaceship on death until re-spawn """
         self.hidden = True
         # Use a timer to re-show ship if there are still lives
-        self.hide_timer = pygame.time.get_ticks()
-        self.rect.center = (SCREEN_WIDTH / 2, SCREEN_HEIGHT + 200)
+        self.hide_timer = get_ticks()
+        self.rect.center = (playfield.width / 2, playfield.height + 200)
 
     def powerup(self):
         """ Powerup player shots on gun powerup """
         self.power += 1
-        self.power_time = pygame.time.get_ticks()
+        self.power_time = get_ticks()
 
 
 class EnemyShip(Spaceship):
@@ -211,40 +291,40 @@ class EnemyShip(Spaceship):
     def __init__(self):
         super().__init__()
         self.lives = 0
-        self.image = pygame.transform.scale(enemyship_img,
-                                            (Spaceship.width - 5,
-                                             Spaceship.height - 5))
-        self.shoot_timer = pygame.time.get_ticks()
-        self.shoot_rate = random.randrange(1000, 4000)
-        self.velocity = [0, random.randrange(2, 7)]
-        self.image.set_colorkey(BLACK)
+        self.image = atlas.image('enemy')
+        self.shoot_timer = get_ticks()
+        self.shoot_rate = rng.randrange(1000, 4000)
+        self.velocity = [0, rng.randrange(2, 7)]
         self.radius = 18
         self.rect = self.image.get_rect()
-        self.rect.x = random.randrange(SCREEN_WIDTH - self.width)
-        self.rect.y = (random.randrange(-300, -20) - Spaceship.height - 5)
+        self.rect.x = rng.randrange(playfield.width - self.width)
+        self.rect.y = (rng.randrange(-300, -20) - Spaceship.height - 5)
         self.y_speed = 0
         self.shoot_sounds = []
         for snd in ['laserfire01.ogg', 'laserfire02.ogg']:
-            self.shoot_sounds.append(pygame.mixer.Sound(path.join(snd_dir,
-                                                                  snd)))
+            self.shoot_sounds.append(load_sound(snd))
 
     def update(self):
         """ Move the enemy ship """
-        self.rect.y += self.velocity[1]
-        if self.rect.y > SCREEN_HEIGHT + self.height:
+        self.drift(1)
+
+    def drift(self, steps):
+        """ Move as far as the enemy ship does in a number of frames. """
+        self.rect.y += self.velocity[1] * steps
+        if self.rect.y > playfield.height + self.height:
             self.reset_pos()
 
     def reset_pos(self):
         """ Call when the enemy falls off the screen. """
-        self.rect.x = random.randrange(SCREEN_WIDTH - self.width)
-        self.rect.y = random.randrange(-300, -20)
+        self.rect.x = rng.randrange(playfield.width - self.width)
+        self.rect.y = rng.randrange(-300, -20)
 
     def shoot(self, all_sprites_list, obstacle_list):
         """ Shoot bullet """
         bullet = Bullet(self.rect.x + (Spaceship.width / 2) -
                         (Bullet.bullet_width / 2), self.rect.y)
         bullet.y_speed = 10
-        bullet.image = bullet_img2
+        bullet.image = atlas.image('bullet_enemy')
         all_sprites_list.add(bullet)
         obstacle_list.add(bullet)
         self.shoot_sound.play()
@@ -254,15 +334,14 @@ class PowerUp(pygame.sprite.Sprite):
     """ This class represents powerups """
     def __init__(self, center):
         super().__init__()
-        self.type = random.choice(['health', 'gun'])
+        self.type = rng.choice(['health', 'gun'])
 
         # There are gun and health powerups
         if self.type == 'health':
-            self.image = powerup_health_img
+            self.image = atlas.image('powerup_health')
         elif self.type == 'gun':
-            self.image = powerup_gun_img
+            self.image = atlas.image('powerup_gun')
 
-        self.image.set_colorkey(BLACK)
         self.rect = self.image.get_rect()
         self.rect.center = center
         # Set powerup speed
@@ -271,7 +350,7 @@ class PowerUp(pygame.sprite.Sprite):
     def update(self):
         self.rect.y += self.y_speed
         # Kill if it moves off the bottom of the screen
-        if self.rect.top > SCREEN_HEIGHT:
+        if self.rect.top > playfield.height:
             self.kill()
 
 
@@ -280,23 +359,28 @@ class Obstacle(pygame.sprite.Sprite):
     def __init__(self, width, height):
         super().__init__()
 
-        self.velocity = [random.randrange(-2, 2), random.randrange(1, 5)]
+        self.velocity = [rng.randrange(-2, 2), rng.randrange(1, 5)]
 
         self.image = pygame.Surface([width, height])
         self.rect = self.image.get_rect()
 
     def reset_pos(self):
         """ Call when the obstacle falls off the screen. """
-        self.velocity = [random.randrange(-2, 2), random.randrange(1, 4)]
-        self.rect.x = random.randrange(SCREEN_WIDTH - self.width)
-        self.rect.y = random.randrange(-300, -20)
+        self.velocity = [rng.randrange(-2, 2), rng.randrange(1, 4)]
+        self.rect.x = rng.randrange(playfield.width - self.width)
+        self.rect.y = rng.randrange(-300, -20)
 
     def update(self):
         """ Move the obstacle. """
-        self.rect.x += self.velocity[0]
-        self.rect.y += self.velocity[1]
+        self.drift(1)
+
+    def drift(self, steps):
+        """ Move as far as the obstacle does in a number of frames, without
+            animating it, for obstacles away from the view. """
+        self.rect.x += self.velocity[0] * steps
+        self.rect.y += self.velocity[1] * steps
         # If obstacle moves off screen, bring it back on screen
-        if self.rect.y > SCREEN_HEIGHT + self.height:
+        if self.rect.y > playfield.height + self.height:
             self.reset_pos()
 
 
@@ -304,37 +388,34 @@ class Asteroid(Obstacle):
     """ This class represents an asteroid obstacle """
 
     def __init__(self):
-        self.width = random.randrange(20, 40)
-        self.height = random.randrange(20, 40)
-        self.meteor_size = random.randrange(30, 60)
+        self.width = rng.randrange(20, 40)
+        self.height = rng.randrange(20, 40)
+        self.meteor_size = rng.randrange(30, 60)
 
         # Call super class constructor with instance dimensions
         super().__init__(self.width, self.height)
         # Keep original image for rotation
-        self.image_orig = pygame.transform.scale(asteroid_img,
-                                                 (self.meteor_size,
-                                                  self.meteor_size))
-        self.image = self.image_orig.copy()
+        self.image = atlas.image('meteor{}'.format(self.meteor_size))
+        self.image_orig = rotation_source(self.image)
         self.rect = self.image.get_rect()
-        self.rect.x = random.randrange(SCREEN_WIDTH - self.width)
-        self.rect.y = random.randrange(-300, -20)
+        self.rect.x = rng.randrange(playfield.width - self.width)
+        self.rect.y = rng.randrange(-300, -20)
         # Define collision radius
         self.radius = int(self.rect.width * .9 / 2)
         self.rot = 0
         # Define random rotation speed
-        self.rot_speed = random.randrange(-9, 9)
-        self.last_update = pygame.time.get_ticks()
+        self.rot_speed = rng.randrange(-9, 9)
+        self.last_update = get_ticks()
         # Store explosion sounds
         self.expl_sounds = []
         for snd in ['expl3.wav', 'expl6.wav']:
-            self.expl_sounds.append(pygame.mixer.Sound(path.join(snd_dir,
-                                                                 snd)))
+            self.expl_sounds.append(load_sound(snd))
         # pygame.draw.circle(self.image, RED, self.rect.center, self.radius)
 
     def rotate(self):
         """ Method to rotate asteroids """
         # Track current time
-        current_time = pygame.time.get_ticks()
+        current_time = get_ticks()
         # Check for last update
         if current_time - self.last_update > 50:
             self.last_update = current_time
@@ -355,17 +436,14 @@ class Debris(Obstacle):
     """ This class represents debri obstacles """
 
     def __init__(self):
-        self.width = random.randrange(10, 16)
-        self.height = random.randrange(10, 16)
-        self.debri_size = random.randrange(10, 16)
+        self.width = rng.randrange(10, 16)
+        self.height = rng.randrange(10, 16)
+        self.debri_size = rng.randrange(10, 16)
 
         super().__init__(self.width, self.height)
-        self.image = debris_img
-        self.image = pygame.transform.scale(debris_img, (self.debri_size,
-                                                         self.debri_size))
-        self.image.set_colorkey(BLACK)
-        self.rect.x = random.randrange(SCREEN_WIDTH - self.width)
-        self.rect.y = random.randrange(-300, 20)
+        self.image = atlas.image('debris{}'.format(self.debri_size))
+        self.rect.x = rng.randrange(playfield.width - self.width)
+        self.rect.y = rng.randrange(-300, 20)
 
 
 class Bullet(pygame.sprite.Sprite):
@@ -376,19 +454,22 @@ class Bullet(pygame.sprite.Sprite):
 
     def __init__(self, x, y):
         super().__init__()
-        self.image = bullet_img
-        self.image.set_colorkey(BLACK)
+        self.image = atlas.image('bullet')
         self.rect = self.image.get_rect()
         self.rect.x = x
         self.rect.y = y
         self.y_speed = -10
 
     def update(self):
-        self.rect.y += self.y_speed
+        self.drift(1)
+
+    def drift(self, steps):
+        """ Move as far as the bullet flies in a number of frames. """
+        self.rect.y += self.y_speed * steps
         # Check if bullet moves off screen
         if self.rect.y < 0:
             self.kill()
-        if self.rect.y > SCREEN_HEIGHT:
+        if self.rect.y > playfield.height:
             self.kill()
 
 
@@ -400,12 +481,12 @@ class Explosion(pygame.sprite.Sprite):
         self.rect = self.image.get_rect()
         self.rect.center = center
         self.frame = 0
-        self.last_update = pygame.time.get_ticks()
+        self.last_update = get_ticks()
         self.frame_rate = 50
 
     def update(self):
         """ Explode and go throw different sprite images until end """
-        current_time = pygame.time.get_ticks()
+        current_time = get_ticks()
         if current_time - self.last_update > self.frame_rate:
             self.last_update = current_time
             self.frame += 1
@@ -418,15 +499,89 @@ class Explosion(pygame.sprite.Sprite):
                 self.rect.center = center
 
 
+class SpawnDirector(object):
+    """ This class spawns the obstacles of a game. Spawns are queued and
+        carried out a few per frame, so that a burst of them doesn't hold
+        up a single frame. """
+
+    # Obstacle kinds, with their sprite class and whether they shoot
+    kinds = {'asteroid': (Asteroid, False),
+             'debris': (Debris, False),
+             'enemy': (EnemyShip, True)}
+
+    def __init__(self, budget=SPAWN_BUDGET, curves=DIFFICULTY_CURVES):
+        self.budget = budget
+        self.curves = curves
+        self.queue = deque()
+
+        # Metrics
+        self.spawned = 0
+        self.spawned_last_frame = 0
+        self.most_in_a_frame = 0
+        self.deepest_queue = 0
+
+    def request(self, kind, count=1):
+        """ Queue obstacles of a kind to be spawned. """
+        self.queue.extend([kind] * count)
+        self.deepest_queue = max(self.deepest_queue, len(self.queue))
+
+    def difficulty(self, name, score):
+        """ Value of a difficulty curve at a score. """
+        points = self.curves[name]
+        if score <= points[0][0]:
+            return points[0][1]
+        for (score0, value0), (score1, value1) in zip(points, points[1:]):
+            if score < score1:
+                return value0 + (value1 - value0) * \
+                    (score - score0) / (score1 - score0)
+        return points[-1][1]
+
+    def replace(self, score):
+        """ Queue the replacement for a destroyed obstacle, an enemy ship
+            or an asteroid depending on the score. Return its kind. """
+        if rng.random() < self.difficulty('enemy_chance', score):
+            kind = 'enemy'
+        else:
+            kind = 'asteroid'
+        self.request(kind)
+        return kind
+
+    def update(self, game):
+        """ Spawn queued obstacles, up to the budget for a frame. """
+        count = min(self.budget, len(self.queue))
+        for _i in range(count):
+            kind = self.queue.popleft()
+            sprite_class, shoots = self.kinds[kind]
+            obstacle = sprite_class()
+            game.add_obstacle(obstacle, shoots)
+            if recorder is not None:
+                recorder.record(telemetry.SPAWN, -1, *obstacle.rect.center,
+                                value=telemetry.OBSTACLES.index(kind))
+
+        self.spawned += count
+        self.spawned_last_frame = count
+        self.most_in_a_frame = max(self.most_in_a_frame, count)
+
+    def metrics(self):
+        return {'queue_depth': len(self.queue),
+                'deepest_queue': self.deepest_queue,
+                'spawned': self.spawned,
+                'spawned_last_frame': self.spawned_last_frame,
+                'most_in_a_frame': self.most_in_a_frame}
+
+
 class Game(object):
     """ This class represents an instance of the game. If we need to
         reset the game we'd just need to create a new instance of this
         class. """
 
-    def __init__(self):
+    def __init__(self, players=1, world_size=None):
         """ Constructor. Create all our attributes and initialize
-        the game. """
+        the game. With world_size, the game is played on a world of that
+        size, larger than the screen. """
 
+        self.players = players
+        self.world_size = world_size
         self.score = 0
         self.highscore = False
         self.high_score = 0
@@ -435,39 +590,54 @@ class Game(object):
         self.game_over = False
         self.game_over_timer = 0
         self.difficulty = 0
-        self.score_file = "score_file.txt"
 
-        # Create sprite lists
+        # Pack the sprite images and build the background, only once since
+        # restarting the game re-runs this constructor
+        load_atlas()
+        load_parallax()
+
+        # Create sprite lists, drawing goes through all_sprites_list. On a
+        # world, obstacles are left out of it, and the world updates and
+        # draws the ones around the view.
         self.bullet_list = pygame.sprite.Group()
         self.enemy_list = pygame.sprite.Group()
-        self.obstacle_list = pygame.sprite.Group()
-        self.all_sprites_list = pygame.sprite.Group()
+        self.all_sprites_list = AtlasGroup(atlas)
         self.powerups = pygame.sprite.Group()
-
-        # Create the block sprites
-        for _i in range(DIFFICULTY):
-            asteroid = Asteroid()
-
-            self.obstacle_list.add(asteroid)
-            self.all_sprites_list.add(asteroid)
-
-        for _x in range(DIFFICULTY//3):
-            debris = Debris()
-
-            self.obstacle_list.add(debris)
-            self.all_sprites_list.add(debris)
-
-        # Create enemy ships
-        for _z in range(DIFFICULTY//5):
-            enemy = EnemyShip()
-
-            self.obstacle_list.add(enemy)
-            self.enemy_list.add(enemy)
-            self.all_sprites_list.add(enemy)
-
-        # Create the player spaceship
-        self.spaceship = Spaceship()
-        self.all_sprites_list.add(self.spaceship)
+        if world_size is None:
+            self.world = None
+            playfield.size = (SCREEN_WIDTH, SCREEN_HEIGHT)
+            self.obstacle_list = pygame.sprite.Group()
+        else:
+            self.world = spatial.World(world_size,
+                                       (SCREEN_WIDTH, SCREEN_HEIGHT))
+            playfield.size = world_size
+            self.obstacle_list = self.world.obstacles
+
+        # Queue the first wave of obstacles and enemy ships, they spawn
+        # above the screen over the first frames. A world gets as many for
+        # every screen of it.
+        screens = playfield.width * playfield.height // \
+            (SCREEN_WIDTH * SCREEN_HEIGHT)
+        self.director = SpawnDirector()
+        self.director.request('asteroid', DIFFICULTY * screens)
+        self.director.request('debris', DIFFICULTY//3 * screens)
+        self.director.request('enemy', DIFFICULTY//5 * screens)
+
+        # Create the player spaceships, spread evenly across the screen,
+        # self.spaceship is the one controlled from this keyboard
+        self.spaceships = []
+        for i in range(players):
+            spaceship = Spaceship(playfield.width * (i + 1) / (players + 1))
+            self.spaceships.append(spaceship)
+            self.all_sprites_list.add(spaceship)
+        self.spaceship = self.spaceships[0]
+
+        # What the camera follows on a world, the spaceship where it was
+        # last seen so that the view stays put while it respawns
+        self.target = self.spaceship.rect.copy()
+
+        if recorder is not None:
+            recorder.record(telemetry.GAME_START, value=players)
 
         # Game music
         pygame.mixer.music.load(path.join(
@@ -478,131 +648,189 @@ class Game(object):
         pygame.mixer.music.play(loops=-1)
 
         # Populate explosion_anim list
-        for i in range(9):
-            filename = 'regularExplosion0{}.png'.format(i)
-            img = pygame.image.load(path.join(img_dir, filename)).convert()
-            img = pygame.transform.scale(img, (60, 60))
-            img.set_colorkey(BLACK)
-            explosion_anim.append(img)
+        if not explosion_anim:
+            for i in range(9):
+                explosion_anim.append(atlas.image('explosion{}'.format(i)))
 
         # Populate spaceship_explosion list
-        for i in range(9):
-            filename = 'sonicExplosion0{}.png'.format(i)
-            img = pygame.image.load(path.join(img_dir, filename)).convert()
-            img.set_colorkey(BLACK)
-            spaceship_explosion.append(img)
-
-        # Set spaceship lives color key
-        self.spaceship_lives_img = pygame.transform.scale(spaceship_img,
-                                                          (25, 19))
-        self.spaceship_lives_img.set_colorkey(BLACK)
-
-    def process_events(self):
-        """ Process all of the events. Return a "True" if we need
-            to close the window. """
+        if not spaceship_explosion:
+            for i in range(9):
+                filename = 'sonicExplosion0{}.png'.format(i)
+                img = pygame.image.load(path.join(img_dir, filename)).convert()
+                img.set_colorkey(BLACK)
+                spaceship_explosion.append(img)
+
+        # Spaceship lives icon
+        self.spaceship_lives_img = atlas.image('lives')
+
+    def process_events(self, events=None):
+        """ Process all of the events, or the ones given. Return a "True"
+            if we need to close the window. """
         if not self.highscore:
-            for event in pygame.event.get():
+            if events is None:
+                events = pygame.event.get()
+            for event in events:
                 if event.type == pygame.QUIT:
                     return True
                 if event.type == pygame.KEYUP:
                     if self.game_over:
-                        time = pygame.time.get_ticks() - self.game_over_timer
-                        if (time > 1000):
-                            self.__init__()
+                        waited = get_ticks() - self.game_over_timer
+                        if (waited > 1000):
+                            self.__init__(self.players, self.world_size)
                 if event.type == pygame.KEYDOWN:
                     if event.key == pygame.K_SPACE:
                         self.spaceship.shoot(self.all_sprites_list,
                                              self.bullet_list)
 
-            for enemy in self.enemy_list:
-                if pygame.time.get_ticks() -
-                enemy.shoot_timer > enemy.shoot_rate:
-                    enemy.shoot(self.all_sprites_list, self.obstacle_list)
-                    enemy.shoot_timer = pygame.time.get_ticks()
+            self.held_fire()
+            self.enemy_fire()
 
         return False
 
+    def held_fire(self):
+        """ Keep firing at the fire rate of each spaceship while fire is
+            held down. """
+        for spaceship in self.spaceships:
+            if spaceship.key_state()[pygame.K_SPACE] and spaceship.reloaded():
+                spaceship.shoot(self.all_sprites_list, self.bullet_list)
+
+    def enemy_fire(self):
+        """ Let every enemy ship whose shoot timer is up fire. On a world,
+            only the enemy ships around the view fire, and their bullets
+            are obstacles of the world like any other. """
+        if self.world is None:
+            enemies = self.enemy_list
+            sprites = self.all_sprites_list
+        else:
+            enemies = [spr for spr in self.world.awake
+                       if spr in self.enemy_list]
+            sprites = self.obstacle_list
+        for enemy in enemies:
+            if get_ticks() - \
+               enemy.shoot_timer > enemy.shoot_rate:
+                enemy.shoot(sprites, self.obstacle_list)
+                enemy.shoot_timer = get_ticks()
+
+    def add_obstacle(self, obstacle, shoots=False):
+        """ Add a newly spawned obstacle to the game. """
+        self.obstacle_list.add(obstacle)
+        if self.world is None:
+            self.all_sprites_list.add(obstacle)
+        if shoots:
+            self.enemy_list.add(obstacle)
+
     def run_logic(self):
         """
         This method is run each time through the frame. It
         updates positions and checks for collisions.
         """
         if not self.game_over and not self.highscore:
-            # Move all the sprites
+            # Spawn the obstacles whose turn it is
+            self.director.update(self)
+
+            # Move all the sprites, on a world the obstacles around the
+            # view follow the spaceship while it is in play
             self.all_sprites_list.update()
+            if self.world is not None:
+                if not self.spaceship.hidden:
+                    self.target = self.spaceship.rect.copy()
+                self.world.update(self.target)
 
-            # See if the player spaceship has collided with anything.
-            hits = pygame.sprite.spritecollide(self.spaceship,
-                                               self.obstacle_list,
-                                               True,
-                                               pygame.sprite.collide_circle)
-
-            # If it has, reduce player spaceship health
-            for hit in hits:
-                self.spaceship.health -= hit.radius * 2
-                # Show explosion and play explosion sound
-                expl = Explosion(hit.rect.center)
-                self.spaceship.expl_sound.play()
-                self.all_sprites_list.add(expl)
-                # If health is below 0, lose a life, otherwise the game ends
-                if self.spaceship.health <= 0:
-                    self.explode_on_death =
-                    Explosion(self.spaceship.rect.center)
-                    self.all_sprites_list.add(self.explode_on_death)
-                    self.spaceship.hide()
-                    self.spaceship.lives -= 1
-                    self.spaceship.health = 100
+            for spaceship in self.spaceships:
+                self.check_spaceship(spaceship)
 
             # End the game only once the final explosion animation completes
-            if self.spaceship.lives <= 0 and not self.explode_on_death.alive():
+            if all(spaceship.lives <= 0 and
+                   not spaceship.death_explosion.alive()
+                   for spaceship in self.spaceships):
                 # Go to highscore mode, where the highscores will be displayed
                 self.highscore = True
 
-            # Check for powerups
-            poweruphits = pygame.sprite.spritecollide(self.spaceship,
-                                                      self.powerups,
-                                                      True)
-
-            for hit in poweruphits:
-                if hit.type == 'health':
-                    self.spaceship.health += random.randrange(10, 30)
-                    if self.spaceship.health >= 100:
-                        self.spaceship.health = 100
-                if hit.type == 'gun':
-                    self.spaceship.powerup()
-
             # See if any of the bullets have hit any of the obstacles.
-            bullet_hit_list = pygame.sprite.groupcollide(self.bullet_list,
-                                                         self.obstacle_list,
-                                                         True,
-                                                         True)
+            bullet_hit_list = spatial.groupcollide(self.bullet_list,
+                                                   self.obstacle_list,
+                                                   True,
+                                                   True)
 
             # Check the list of collisions.
             for obstacle in bullet_hit_list:
-                dice_roll = random.randint(1, 6)
-                if dice_roll > 4:
-                    enemy = EnemyShip()
-                    self.all_sprites_list.add(enemy)
-                    self.obstacle_list.add(enemy)
-                    self.enemy_list.add(enemy)
-                    enemy.expl_sound.play()
+                # Replace the obstacle, more likely with an enemy ship the
+                # higher the score
+                if self.director.replace(self.score) == 'enemy':
+                    load_sound('explosion.wav').play()
                 else:
-                    asteroid = Asteroid()
-                    self.all_sprites_list.add(asteroid)
-                    self.obstacle_list.add(asteroid)
-                    random.choice(asteroid.expl_sounds).play()
+                    load_sound(random.choice(['expl3.wav',
+                                              'expl6.wav'])).play()
                 self.score += 1
+                if recorder is not None:
+                    recorder.record(telemetry.KILL, -1,
+                                    *obstacle.rect.center, value=self.score)
                 expl = Explosion(obstacle.rect.center)
                 self.all_sprites_list.add(expl)
-                if random.random() > 0.9:
+                if rng.random() < self.director.difficulty('powerup_chance',
+                                                           self.score):
                     powerup = PowerUp(obstacle.rect.center)
                     self.all_sprites_list.add(powerup)
                     self.powerups.add(powerup)
                     # print(self.score)
 
-            if len(self.obstacle_list) == 0:
+            if len(self.obstacle_list) == 0 and not self.director.queue:
                 self.highscore = True
 
+    def check_spaceship(self, spaceship):
+        """ Check a player spaceship for collisions with obstacles and
+            powerups. """
+        # See if the player spaceship has collided with anything.
+        hits = spatial.spritecollide(spaceship,
+                                     self.obstacle_list,
+                                     True,
+                                     pygame.sprite.collide_circle)
+
+        player = self.spaceships.index(spaceship)
+
+        # If it has, reduce player spaceship health
+        for hit in hits:
+            spaceship.health -= hit.radius * 2
+            if recorder is not None:
+                recorder.record(telemetry.DAMAGE, player,
+                                *spaceship.rect.center, value=hit.radius * 2)
+            # Show explosion and play explosion sound
+            expl = Explosion(hit.rect.center)
+            spaceship.expl_sound.play()
+            self.all_sprites_list.add(expl)
+            # If health is below 0, lose a life, otherwise the game ends
+            if spaceship.health <= 0:
+                # Where it died, hiding moves the spaceship off screen
+                died_at = spaceship.rect.center
+                spaceship.death_explosion = Explosion(died_at)
+                self.all_sprites_list.add(spaceship.death_explosion)
+                spaceship.hide()
+                spaceship.lives -= 1
+                spaceship.health = 100
+                if recorder is not None:
+                    recorder.record(telemetry.LIFE_LOST, player, *died_at,
+                                    value=spaceship.lives)
+                # Out of lives, keep the spaceship hidden for good
+                if spaceship.lives <= 0:
+                    spaceship.kill()
+
+        # Check for powerups
+        poweruphits = pygame.sprite.spritecollide(spaceship,
+                                                  self.powerups,
+                                                  True)
+
+        for hit in poweruphits:
+            if recorder is not None:
+                recorder.record(telemetry.POWERUP, player,
+                                *spaceship.rect.center,
+                                value=telemetry.POWERUPS.index(hit.type))
+            if hit.type == 'health':
+                spaceship.health += rng.randrange(10, 30)
+                if spaceship.health >= 100:
+                    spaceship.health = 100
+            if hit.type == 'gun':
+                spaceship.powerup()
+
     # High score entry box, loaded on death
     def enterbox(self, screen, txt, font):
         """ Represents the high score entry box """
@@ -665,7 +893,7 @@ class Game(object):
         # Highscore display mode, prompt for user name and then show top 10
         if self.highscore:
             font = pygame.font.Font(font_name, 18)
-            self.high_name, self.high_score = read_high_score(self.score_file)
+            self.high_name, self.high_score = leaderboard.high_score()
 
             # Oh look, you found the easter egg!
             riddle = random.choice(
@@ -703,12 +931,12 @@ class Game(object):
                 self.highscore = False
                 return
 
-            # Write current score to score file
-            write_out(self.score_file, self.cur_name, self.score)
+            # Submit the current score to the leaderboard
+            leaderboard.submit(self.cur_name, self.score)
 
             # Show top ten scores
-            if top10_scores(screen, self.score_file, font) is False:
-                self.game_over_timer = pygame.time.get_ticks()
+            if top10_scores(screen, leaderboard.top(10), font) is False:
+                self.game_over_timer = get_ticks()
                 self.highscore = False
                 self.game_over = True
 
@@ -722,51 +950,56 @@ class Game(object):
                       SCREEN_WIDTH / 2, SCREEN_HEIGHT / 2)
             draw_text(screen, "Press any key to begin", 18,
                       SCREEN_WIDTH / 2, SCREEN_HEIGHT * 3 / 4)
-            pygame.display.flip()
+            show_frame(screen)
 
         # Otherwise, display game objects
         if not self.game_over and not self.highscore:
 
-            screen.fill(BLACK)
-            screen.blit(background, background_rect)
-
-            self.all_sprites_list.draw(screen)
+            # The background covers the whole screen, no need to clear it
+            parallax.draw(screen, get_ticks())
 
-            # Draw score
-            draw_text(screen, str(self.score), 18, SCREEN_WIDTH/2, 10)
-
-            # Draw lives
-            draw_lives(screen, SCREEN_WIDTH - 100, 5, self.spaceship.lives,
-                       self.spaceship_lives_img)
-
-            # Draw health bar
-            draw_health_bar(screen, 5, 5, self.spaceship.health)
-
-            pygame.display.flip()
-
-
-# Show the top 10 scores from the score file
-def top10_scores(screen, file_name, font):
+            if self.world is None:
+                self.all_sprites_list.draw(screen)
+            else:
+                screen.blits(self.world.blits(self.all_sprites_list,
+                                              atlas.blit_item),
+                             doreturn=False)
+
+            draw_hud(screen, self.score,
+                     [(ship.lives, ship.health) for ship in self.spaceships],
+                     self.spaceship_lives_img)
+
+            show_frame(screen)
+
+    def take_snapshot(self, snapshot):
+        """ Fill in a snapshot of the frame, for drawing on another
+            thread. The sprite images are shared, their rects copied. """
+        blit_item = atlas.blit_item
+        if self.world is None:
+            snapshot.blits[:] = [blit_item(spr.image, spr.rect.copy())
+                                 for spr in self.all_sprites_list]
+        else:
+            snapshot.blits[:] = self.world.blits(self.all_sprites_list,
+                                                 blit_item)
+        snapshot.ticks = get_ticks()
+        snapshot.score = self.score
+        snapshot.players = [(ship.lives, ship.health)
+                            for ship in self.spaceships]
+
+    def draw_snapshot(self, screen, snapshot):
+        """ Draw a snapshot of the game taken by take_snapshot. """
+        parallax.draw(screen, snapshot.ticks)
+        screen.blits(snapshot.blits, doreturn=False)
+        draw_hud(screen, snapshot.score, snapshot.players,
+                 self.spaceship_lives_img)
+        show_frame(screen)
+
+
+# Show the top 10 scores, given as (score, name) from the leaderboard
+def top10_scores(screen, best_scores, font):
     x_length = SCREEN_WIDTH
     y_length = SCREEN_HEIGHT
 
-    file = open(file_name, 'r')
-    rows = file.readlines()
-
-    # Iterate through rows
-    all_scores = []
-    for row in rows:
-        sep = row.index(',')
-        name = row[:sep]
-        score = int(row[sep+1:-1])
-        all_scores.append((score, name))
-
-    file.close()
-
-    # Sort scores
-    all_scores.sort(reverse=True)
-    best_scores = all_scores[:10]
-
     screen.fill(BLACK)
     box = pygame.surface.Surface((x_length, y_length))
     box.fill(PURPLE)
@@ -790,31 +1023,11 @@ def top10_scores(screen, file_name, font):
 
     while True:
         for event in pygame.event.get():
-            if event.type == pygame.KEYDOWN and
-            event.key in [pygame.K_RETURN, pygame.K_KP_ENTER]:
+            if event.type == pygame.KEYDOWN and \
+               event.key in [pygame.K_RETURN, pygame.K_KP_ENTER]:
                 return False
 
 
-# Read the high score name and value from the score file
-def read_high_score(file_name):
-    file = open(file_name, 'r')
-    rows = file.readlines()
-    file.close
-
-    high_score = 0
-    high_name = ""
-
-    for row in rows:
-        name, score = row.strip().split(",")
-        score = int(score)
-
-        if score > high_score:
-            high_score = score
-            high_name = name
-
-    return high_name, high_score
-
-
 # Startup splash screen
 def draw_start_screen(screen):
     screen.fill(BLACK)
@@ -847,6 +1060,15 @@ def draw_lives(surf, x, y, lives, img):
         surf.blit(img, img_rect)
 
 
+# Draw score, and the lives and health bar of each player on a row of its
+# own, from a list of lives and health
+def draw_hud(surf, score, players, lives_img):
+    draw_text(surf, str(score), 18, SCREEN_WIDTH/2, 10)
+    for i, (lives, health) in enumerate(players):
+        draw_lives(surf, SCREEN_WIDTH - 100, 5 + 22 * i, lives, lives_img)
+        draw_health_bar(surf, 5, 5 + 22 * i, health)
+
+
 # Draw health bar
 def draw_health_bar(surf, x, y, pct):
     if pct < 0:
@@ -862,15 +1084,99 @@ def draw_health_bar(surf, x, y, pct):
     pygame.draw.rect(surf, WHITE, outline_rect, 2)
 
 
-# Write out to the score file
-def write_out(score_file, name, score):
-    open_scores_file = open(score_file, 'a')
-    print(name + ",", score, file=open_scores_file)
-    open_scores_file.close()
+# Convert an image for the atlas at the given size, with black transparent
+# the same way the color key made it
+def atlas_image(img, size=None):
+    if size is not None:
+        img = pygame.transform.scale(img, size)
+    img.set_colorkey(BLACK)
+    return img.convert_alpha()
+
+
+# Pack every fixed sprite image onto the atlas sheets, once the display
+# mode is set. Asteroids and debris come in a range of sizes, each of which
+# is packed, so that sprites never scale their own copy.
+def load_atlas():
+    if atlas.images:
+        return
+
+    images = {}
+    images['player'] = atlas_image(spaceship_img,
+                                   (Spaceship.width, Spaceship.height))
+    images['player_damaged'] = atlas_image(spaceship_dmg,
+                                           (Spaceship.width,
+                                            Spaceship.height))
+    images['enemy'] = atlas_image(enemyship_img, (Spaceship.width - 5,
+                                                  Spaceship.height - 5))
+    images['lives'] = atlas_image(spaceship_img, (25, 19))
+    images['bullet'] = atlas_image(bullet_img)
+    images['bullet_enemy'] = atlas_image(bullet_img2)
+    images['powerup_health'] = atlas_image(powerup_health_img)
+    images['powerup_gun'] = atlas_image(powerup_gun_img)
+    for size in range(30, 60):
+        images['meteor{}'.format(size)] = atlas_image(asteroid_img,
+                                                      (size, size))
+    for size in range(10, 16):
+        images['debris{}'.format(size)] = atlas_image(debris_img,
+                                                      (size, size))
+    for i in range(9):
+        filename = 'regularExplosion0{}.png'.format(i)
+        img = pygame.image.load(path.join(img_dir, filename)).convert()
+        images['explosion{}'.format(i)] = atlas_image(img, (60, 60))
+
+    atlas.pack(images)
+
+
+# Build the parallax background layers once the display mode is set: the
+# space field at the back, and two layers of stars from the star field
+# moving faster in front of it
+def load_parallax():
+    if parallax.layers:
+        return
+
+    size = (SCREEN_WIDTH, SCREEN_HEIGHT)
+    parallax.add(OpaqueLayer(background, size, 12))
+    stars = pygame.image.load(path.join(img_dir, 'starfield.png'))
+    parallax.add(StarLayer(stars.subsurface((0, 0), size), size, 40))
+    stars = pygame.transform.flip(stars, True, False)
+    parallax.add(StarLayer(stars.subsurface((0, 0), size), size, 90))
+
+
+# Image of its own for rotating an atlas image from, shared by every sprite
+# of that size. Rotating straight from the atlas would lock its sheet, which
+# must stay free for drawing while the pipeline simulates on another thread.
+def rotation_source(image):
+    if image not in rotation_sources:
+        rotation_sources[image] = image.copy()
+    return rotation_sources[image]
+
+
+# Load a sound once and share it between all sprites that play it
+def load_sound(filename):
+    if filename not in sounds:
+        sounds[filename] = pygame.mixer.Sound(path.join(snd_dir, filename))
+    return sounds[filename]
+
+
+# Show a frame of the game, handing it to the video capture first if the
+# game is being captured
+def show_frame(screen):
+    if video_capture is not None:
+        video_capture.frame(screen)
+    pygame.display.flip()
 
 
-def main():
-    """ Main program function. """
+def main(pipelined=False, latency=False, telemetry_dir=None,
+         world_size=None, capture_dir=None, leaderboard_url=None):
+    """ Main program function. With pipelined, the game is simulated on
+    a thread of its own while it is being played. With latency, a
+    histogram of input to flip latency is printed on exit. With
+    telemetry_dir, the session is recorded into that directory. With
+    world_size, the game is played on a world of that size. With
+    capture_dir, the frames of the game are captured as images into that
+    directory. With leaderboard_url, high scores are shared through the
+    leaderboard server at that address. """
+    global recorder, video_capture, leaderboard
     # Initialize Pygame and set up the window
     pygame.init()
 
@@ -892,27 +1198,90 @@ def main():
             if event.type == pygame.KEYUP:
                 waiting = False
 
+    if telemetry_dir is not None:
+        recorder = telemetry.Recorder(telemetry_dir,
+                                      clock=lambda: get_ticks())
+
+    if leaderboard_url is not None:
+        leaderboard = RemoteBackend(leaderboard_url,
+                                    "leaderboard_queue.jsonl")
+
+    if capture_dir is not None:
+        from video import VideoCapture
+        video_capture = VideoCapture(capture_dir, screen, FPS)
+
     # Create an instance of the Game class
-    game = Game()
+    game = Game(world_size=world_size)
+    controls = Controls(FPS)
 
     # Main game loop
     while not done:
 
+        # Play on the pipeline until the game is over
+        if pipelined and not game.game_over and not game.highscore:
+            from pipeline import Pipeline
+            done = Pipeline(game, FPS, recorder,
+                            controls.histogram).run(screen)
+            continue
+
         # Process events (keystrokes, mouse clicks, etc)
-        done = game.process_events()
+        started = time.perf_counter()
+        done = game.process_events(controls.sample())
 
         # Update object positions, check for collisions
         game.run_logic()
 
         # Draw the current frame
+        playing = not game.game_over and not game.highscore
         game.display_frame(screen)
-
-        # Pause for the next frame
-        clock.tick(FPS)
-
-    # Close window and exit
-    pygame.quit()
-
-# Call the main function, start up the game
+        controls.flipped(playing)
+        # Frames of prompts and high score screens aren't gameplay
+        if recorder is not None and playing:
+            recorder.frame(time.perf_counter() - started)
+
+        # Pause for the next frame, taking in input as it comes
+        controls.wait()
+
+    # Close everything down, even if closing the capture fails
+    try:
+        if video_capture is not None:
+            capture, video_capture = video_capture, None
+            stats = capture.close()
+            print("Captured {captured} frames, dropped {dropped}".format(
+                **stats))
+    finally:
+        # Close window and exit
+        pygame.quit()
+
+        # Scores not sent yet stay queued for next time
+        leaderboard.close()
+
+        if recorder is not None:
+            recorder.close()
+            recorder = None
+
+    if latency:
+        print("\n".join(controls.histogram.report()))
+
+# Call the main function with the options given, start up the game
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Project S")
+    parser.add_argument('--pipelined', action='store_true',
+                        help="simulate on a thread of its own")
+    parser.add_argument('--latency', action='store_true',
+                        help="print input to flip latency on exit")
+    parser.add_argument('--telemetry', action='store_true',
+                        help="record the session into telemetry/")
+    parser.add_argument('--world', action='store_true',
+                        help="play on a world eight screens wide")
+    parser.add_argument('--capture', action='store_true',
+                        help="capture the frames as images into capture/")
+    parser.add_argument('--leaderboard', type=server_url, metavar='URL',
+                        help="share high scores through a leaderboard "
+                        "server")
+    args = parser.parse_args()
+    main(pipelined=args.pipelined, latency=args.latency,
+         telemetry_dir='telemetry' if args.telemetry else None,
+         world_size=WORLD_SIZE if args.world else None,
+         capture_dir='capture' if args.capture else None,
+         leaderboard_url=args.leaderboard)
@@ -0,0 +1,200 @@
+'''
+@description: Sprite atlas for the game graphics. The sprite images are
+              packed onto a few display-format sheets once, at startup, and
+              each sprite image is a subsurface of its sheet, so it shares
+              the pixels of the sheet instead of owning a surface of its
+              own.
+
+              AtlasGroup draws a sprite group with a single Surface.blits
+              call, blitting each sprite straight from its sheet with the
+              sub-rect of the image. Sprites whose image is not on a sheet,
+              such as the rotated asteroids, are drawn in the same batch
+              from their own surface.
+
+@instruction: Running this file benchmarks drawing a screen full of game
+              sprites with pygame.sprite.Group, from one surface per sprite
+              in the pixel format PNGs load in (how the game drew them
+              before) and in display format, against drawing them from the
+              atlas with AtlasGroup:
+
+                  python atlas.py
+'''
+import pygame
+
+# Largest sheet, big enough to hold all of the game graphics on one or two
+SHEET_SIZE = (512, 512)
+
+# Space left between images, so scaled or filtered blits don't bleed
+PADDING = 1
+
+
+class Atlas(object):
+    """ This class represents a set of sheets that images are packed on. """
+    def __init__(self, sheet_size=SHEET_SIZE):
+        self.sheet_size = sheet_size
+        self.sheets = []
+        self.images = {}
+        # Sheet and area of every packed image, used when batching blits
+        self.sources = {}
+
+    def pack(self, images):
+        """ Pack a dictionary of name: surface onto sheets. The images are
+            placed on shelves, tallest first, starting a new sheet once
+            one is full. Needs the display mode to have been set. """
+        sheet_w, sheet_h = self.sheet_size
+        order = sorted(images, key=lambda name: images[name].get_height(),
+                       reverse=True)
+
+        placed = []
+        shelf_x = shelf_y = shelf_h = 0
+        sheet = -1
+        for name in order:
+            width, height = images[name].get_size()
+            if width > sheet_w or height > sheet_h:
+                raise ValueError("{} is too large for an atlas sheet"
+                                 .format(name))
+            # Start a new shelf, or a new sheet if the shelf doesn't fit
+            if sheet < 0 or shelf_x + width > sheet_w:
+                shelf_x = 0
+                shelf_y += shelf_h
+                shelf_h = 0
+            if sheet < 0 or shelf_y + height > sheet_h:
+                sheet += 1
+                shelf_x = shelf_y = shelf_h = 0
+            placed.append((name, sheet,
+                           pygame.Rect(shelf_x, shelf_y, width, height)))
+            shelf_x += width + PADDING
+            shelf_h = max(shelf_h, height + PADDING)
+
+        # Size each sheet to what was placed on it
+        sizes = [[0, 0] for _i in range(sheet + 1)]
+        for name, index, rect in placed:
+            sizes[index][0] = max(sizes[index][0], rect.right)
+            sizes[index][1] = max(sizes[index][1], rect.bottom)
+
+        first = len(self.sheets)
+        for size in sizes:
+            surf = pygame.Surface(size, pygame.SRCALPHA).convert_alpha()
+            surf.fill((0, 0, 0, 0))
+            self.sheets.append(surf)
+
+        # Copy the pixels over as they are, alpha included
+        for name, index, rect in placed:
+            surf = self.sheets[first + index]
+            surf.blit(images[name], rect, special_flags=pygame.BLEND_RGBA_MAX)
+            image = surf.subsurface(rect)
+            self.images[name] = image
+            self.sources[image] = (surf, rect)
+
+    def blit_item(self, image, rect):
+        """ Item of a Surface.blits sequence that draws an image at rect,
+            from its sheet if it is on one. """
+        source = self.sources.get(image)
+        if source is None:
+            return (image, rect)
+        return (source[0], rect, source[1])
+
+    def image(self, name):
+        """ Return the image with the given name, a subsurface of its
+            sheet. """
+        return self.images[name]
+
+    def surface_count(self):
+        return len(self.sheets)
+
+    def pixel_bytes(self):
+        return sum(surf.get_pitch() * surf.get_height()
+                   for surf in self.sheets)
+
+
+class AtlasGroup(pygame.sprite.Group):
+    """ Sprite group that draws all of its sprites in one batch of blits,
+        from the atlas sheets where it can. """
+    def __init__(self, atlas, *sprites):
+        super().__init__(*sprites)
+        self.atlas = atlas
+
+    def draw(self, surface):
+        """ Draw all sprites onto the surface, in the order they were
+            added, with a single Surface.blits call. """
+        sprites = self.sprites()
+        blit_item = self.atlas.blit_item
+        rects = surface.blits([blit_item(spr.image, spr.rect)
+                               for spr in sprites])
+        self.spritedict.update(zip(sprites, rects))
+        self.lostsprites = []
+        return rects
+
+
+# Pixel format of a 32 bit PNG as pygame.image.load returns it
+PNG_MASKS = (0xff, 0xff00, 0xff0000, 0xff000000)
+
+
+# Time drawing the same sprites from separate surfaces and from the atlas
+def benchmark(frames=2000, sprite_count=300):
+    import os
+    import random
+    import time
+
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    pygame.init()
+    import Project_S_Game as game
+
+    screen = pygame.display.set_mode([game.SCREEN_WIDTH,
+                                      game.SCREEN_HEIGHT])
+    game.load_atlas()
+    names = sorted(game.atlas.images)
+    rng = random.Random(1)
+
+    unconverted = pygame.sprite.Group()
+    plain = pygame.sprite.Group()
+    batched = AtlasGroup(game.atlas)
+    for _i in range(sprite_count):
+        name = rng.choice(names)
+        image = game.atlas.image(name)
+        pos = (rng.randrange(game.SCREEN_WIDTH),
+               rng.randrange(game.SCREEN_HEIGHT))
+
+        # One surface per sprite, the way the game loaded them before
+        spr = pygame.sprite.Sprite()
+        spr.image = pygame.Surface(image.get_size(), pygame.SRCALPHA, 32,
+                                   PNG_MASKS)
+        spr.image.blit(image, (0, 0))
+        spr.image.set_colorkey(game.BLACK)
+        spr.rect = spr.image.get_rect(center=pos)
+        unconverted.add(spr)
+
+        spr = pygame.sprite.Sprite()
+        spr.image = image.copy()
+        spr.rect = spr.image.get_rect(center=pos)
+        plain.add(spr)
+
+        spr = pygame.sprite.Sprite()
+        spr.image = image
+        spr.rect = spr.image.get_rect(center=pos)
+        batched.add(spr)
+
+    results = []
+    for label, group in [("Group.draw, PNG format", unconverted),
+                         ("Group.draw, display format", plain),
+                         ("AtlasGroup.draw, atlas sheets", batched)]:
+        start = time.perf_counter()
+        for _i in range(frames):
+            screen.fill(game.BLACK)
+            group.draw(screen)
+        elapsed = time.perf_counter() - start
+        results.append((label, elapsed))
+
+    print("{} sprites, {} frames".format(sprite_count, frames))
+    for label, elapsed in results:
+        print("{:<32}{:>9.3f} ms/frame{:>12.0f} blits/s".format(
+            label, elapsed * 1000 / frames,
+            sprite_count * frames / elapsed))
+    print("Surfaces: {} separate, {} atlas sheets ({} KB)".format(
+        sprite_count, game.atlas.surface_count(),
+        game.atlas.pixel_bytes() // 1024))
+    pygame.quit()
+
+
+if __name__ == "__main__":
+    benchmark()
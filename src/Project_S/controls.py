@@ -0,0 +1,120 @@
+'''
+@description: Low latency input for the main loop. Rather than sleeping a
+              whole frame away in clock.tick and picking the input up
+              afterwards, the wait between frames is sliced up, and events
+              are taken in and timestamped as they arrive. Input is handed
+              to the game right before the simulation step, the held keys
+              are read after that.
+
+              The timestamps give the time from every key event to the
+              flip of the first frame that shows its effect, which is
+              gathered into a histogram.
+
+@instruction: Play with the histogram printed on exit:
+
+                  python Project_S_Game.py --latency
+'''
+import time
+
+import pygame
+
+# Longest sleep between looking for events, in seconds
+WAIT_SLICE = 0.001
+
+# Events whose latency is measured
+INPUT_EVENTS = (pygame.KEYDOWN, pygame.KEYUP)
+
+
+class LatencyHistogram(object):
+    """ This class represents a histogram of latencies, in buckets of step
+        milliseconds up to a limit and one bucket for anything above.
+        Percentiles are read from the buckets, so the histogram stays the
+        same size however long the game is played. """
+    def __init__(self, limit=50, step=1.0):
+        self.limit = limit
+        self.step = step
+        self.buckets = [0] * (int(limit / step) + 1)
+        self.count = 0
+        self.most = 0.0
+
+    def add(self, seconds):
+        ms = seconds * 1000
+        self.buckets[min(int(ms / self.step), len(self.buckets) - 1)] += 1
+        self.count += 1
+        self.most = max(self.most, ms)
+
+    def percentile(self, pct):
+        """ Upper edge of the bucket the percentile falls in, or the
+            longest latency if that is less. """
+        rank = min(self.count - 1, self.count * pct // 100)
+        seen = 0
+        for index, count in enumerate(self.buckets[:-1]):
+            seen += count
+            if seen > rank:
+                return min((index + 1) * self.step, self.most)
+        return self.most
+
+    def report(self, title="Input to flip latency", width=40):
+        """ Return the histogram as lines of text. """
+        if not self.count:
+            return [title + ": no input"]
+        lines = ["{}: {} events, median {:.1f} ms, p95 {:.1f} ms, "
+                 "p99 {:.1f} ms, max {:.1f} ms".format(
+                     title, self.count, self.percentile(50),
+                     self.percentile(95), self.percentile(99), self.most)]
+        most = max(self.buckets)
+        last = len(self.buckets) - 1
+        for index, count in enumerate(self.buckets):
+            if count:
+                label = "{:>3g} ms".format(index * self.step) \
+                    if index < last else ">{:>2g} ms".format(self.limit)
+                lines.append("{} {:>6} {}".format(
+                    label, count, "#" * max(1, count * width // most)))
+        return lines
+
+
+class Controls(object):
+    """ Takes in events between frames with the time they came in, and
+        measures how long they take to reach the screen. """
+    def __init__(self, fps):
+        self.period = 1 / fps
+        self.deadline = time.perf_counter()
+        self.pending = []
+        self.stamps = []
+        self.histogram = LatencyHistogram()
+
+    def collect(self):
+        now = time.perf_counter()
+        for event in pygame.event.get():
+            self.pending.append((now, event))
+
+    def wait(self):
+        """ Wait for the next frame, taking in events as they come. """
+        self.deadline += self.period
+        now = time.perf_counter()
+        # Running late, don't try to catch up
+        if self.deadline < now:
+            self.deadline = now
+        while now < self.deadline:
+            self.collect()
+            time.sleep(min(self.deadline - now, WAIT_SLICE))
+            now = time.perf_counter()
+
+    def sample(self):
+        """ Hand over the events that came in since the last frame, right
+            before they are acted on. """
+        self.collect()
+        events = [event for _stamp, event in self.pending]
+        self.stamps += [stamp for stamp, event in self.pending
+                        if event.type in INPUT_EVENTS]
+        self.pending = []
+        return events
+
+    def flipped(self, shown=True):
+        """ Call once the frame is on screen. The input taken for it is
+            measured, unless the frame didn't show play. """
+        if shown:
+            now = time.perf_counter()
+            for stamp in self.stamps:
+                self.histogram.add(now - stamp)
+        self.stamps = []
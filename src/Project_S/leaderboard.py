@@ -0,0 +1,571 @@
+'''
+@description: High score leaderboards. The game submits scores to, and
+              reads the top scores from, one of two backends:
+
+                  - LocalBackend keeps them in the local score file, as the
+                    game always has
+                  - RemoteBackend shares them with every cabinet through a
+                    leaderboard server over HTTP
+
+              The game never waits on the network. RemoteBackend answers
+              from memory: the top scores come from a cache that is
+              refreshed in the background once it is older than TOP_TTL,
+              merged with the scores that haven't been sent yet and those
+              sent since the cache was last refreshed. Submitted
+              scores go into an offline queue on disk first, and a worker
+              thread sends them to the server in batches over a persistent
+              connection. When the server can't be reached the
+              worker backs off and tries again, and the queue survives
+              restarts, so scores reach the server once it is back.
+
+              Every score carries an id, so a batch that is sent again
+              after its answer was lost is only counted once.
+
+              StubServer is a small leaderboard server kept in memory, for
+              trying the game out against and for load benchmarks.
+
+@instruction: Run a stub server, and play against it:
+
+                  python leaderboard.py serve --port 8765
+                  python Project_S_Game.py --leaderboard http://localhost:8765
+
+              Benchmark the client against the stub server, and check that
+              scores queued while the server is down get there once it is
+              up:
+
+                  python leaderboard.py bench
+'''
+import argparse
+import http.client
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Seconds the cached top scores are good for, and how many are cached
+TOP_TTL = 30.0
+TOP_COUNT = 10
+
+# Most scores sent in one request
+BATCH_SIZE = 50
+
+# Seconds before a request is given up on
+REQUEST_TIMEOUT = 5.0
+
+# Seconds closing waits for a request in flight to finish
+CLOSE_TIMEOUT = 1.0
+
+# Seconds to wait after a failed request, doubling up to the most
+RETRY_DELAY = 0.5
+MAX_RETRY_DELAY = 30.0
+
+
+# Check that a URL is one a leaderboard server can be reached at, and
+# return it
+def server_url(url):
+    address = urlparse(url)
+    if address.scheme != 'http' or not address.hostname:
+        raise ValueError("not an http:// address: {}".format(url))
+    return url
+
+
+class LocalBackend(object):
+    """ This class represents the leaderboard in the local score file, a
+        "name, score" line for every score. """
+    def __init__(self, file_name):
+        self.file_name = file_name
+
+    def read_scores(self):
+        if not os.path.exists(self.file_name):
+            return []
+        scores = []
+        with open(self.file_name, 'r') as score_file:
+            for row in score_file:
+                if row.strip():
+                    name, score = row.rsplit(',', 1)
+                    scores.append((int(score), name))
+        return scores
+
+    def submit(self, name, score):
+        with open(self.file_name, 'a') as score_file:
+            print(name + ",", score, file=score_file)
+
+    def top(self, count=10):
+        """ The best scores, as (score, name), best first. """
+        return sorted(self.read_scores(), reverse=True)[:count]
+
+    def high_score(self):
+        """ Name and score of the high score, the first one made. """
+        high_score = 0
+        high_name = ""
+        for score, name in self.read_scores():
+            if score > high_score:
+                high_score = score
+                high_name = name
+        return high_name, high_score
+
+    def close(self):
+        pass
+
+
+class PersistentConnection(object):
+    """ An HTTP connection to a server that is kept open between requests,
+        and opened again once closed. """
+    def __init__(self, host, port, timeout=REQUEST_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.connection = None
+
+        # Metrics
+        self.opened = 0
+
+    def request(self, method, path, body=None):
+        """ Make a request, return the status and decoded JSON answer.
+            Raises OSError, http.client.HTTPException or ValueError if it
+            fails. """
+        headers = {}
+        if body is not None:
+            body = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+
+        # A connection left idle may have been closed by the server, in
+        # which case the request is made once more on a new one
+        reused = self.connection is not None
+        while True:
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection(
+                    self.host, self.port, timeout=self.timeout)
+                self.opened += 1
+            try:
+                self.connection.request(method, path, body, headers)
+                response = self.connection.getresponse()
+                data = response.read()
+                status = response.status
+                if response.will_close:
+                    self.close()
+                return status, json.loads(data) if data else None
+            except (OSError, http.client.HTTPException, ValueError):
+                self.close()
+                if not reused:
+                    raise
+                reused = False
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+class OfflineQueue(object):
+    """ Scores waiting to be sent, kept in a file of JSON lines so that
+        they outlast the game. Its methods may be called from any thread,
+        only writers wait for the file. """
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.entries = []
+        # The lock guards the entries, the file lock the file, so that
+        # reading the entries never waits on the disk
+        self.lock = threading.Lock()
+        self.file_lock = threading.Lock()
+        if os.path.exists(file_name):
+            with open(file_name, 'r') as queue_file:
+                for line in queue_file:
+                    try:
+                        self.entries.append(json.loads(line))
+                    except ValueError:
+                        # Torn last line from a crash mid write
+                        pass
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+    def peek(self, count=None):
+        """ The entries waiting, or the first count of them. """
+        with self.lock:
+            return self.entries[:count]
+
+    def append(self, entry):
+        with self.file_lock:
+            with open(self.file_name, 'a') as queue_file:
+                queue_file.write(json.dumps(entry) + '\n')
+                queue_file.flush()
+                os.fsync(queue_file.fileno())
+            with self.lock:
+                self.entries.append(entry)
+
+    def remove(self, ids):
+        """ Drop the entries that were sent, rewriting the file. Entries
+            are appended to the file while holding the file lock, so none
+            go missing from the rewrite. """
+        with self.file_lock:
+            with self.lock:
+                self.entries = [entry for entry in self.entries
+                                if entry['id'] not in ids]
+                entries = self.entries
+            part = self.file_name + '.part'
+            with open(part, 'w') as queue_file:
+                for entry in entries:
+                    queue_file.write(json.dumps(entry) + '\n')
+                queue_file.flush()
+                os.fsync(queue_file.fileno())
+            os.replace(part, self.file_name)
+
+
+class RemoteBackend(object):
+    """ This class represents a leaderboard on a server, talked to from a
+        worker thread so that none of its methods wait on the network. """
+    def __init__(self, url, queue_file, ttl=TOP_TTL, batch_size=BATCH_SIZE):
+        address = urlparse(server_url(url))
+        self.connection = PersistentConnection(address.hostname,
+                                               address.port or 80)
+        self.ttl = ttl
+        self.batch_size = batch_size
+        self.lock = threading.Condition()
+        self.queue = OfflineQueue(queue_file)
+        self.cached = []
+        self.cached_at = None
+        # Best entries sent since the cache was refreshed, which the cache
+        # doesn't have yet, by id
+        self.sent_entries = {}
+        self.refresh_wanted = True
+        self.retry_at = 0.0
+        self.retry_delay = RETRY_DELAY
+        self.closed = False
+
+        # Metrics
+        self.batches = 0
+        self.sent = 0
+        self.failures = 0
+
+        self.worker = threading.Thread(target=self.run, name="leaderboard",
+                                       daemon=True)
+        self.worker.start()
+
+    def submit(self, name, score):
+        """ Queue a score to be sent. """
+        entry = {'id': uuid.uuid4().hex, 'name': name, 'score': score}
+        self.queue.append(entry)
+        with self.lock:
+            self.lock.notify()
+
+    def top(self, count=10):
+        """ The best scores known, as (score, name), best first: the cached
+            ones from the server along with those sent since and those not
+            sent yet. """
+        with self.lock:
+            if self.cached_at is None or \
+               time.monotonic() - self.cached_at > self.ttl:
+                self.refresh_wanted = True
+                self.lock.notify()
+            scores = self.cached + list(self.sent_entries.values())
+            sent = set(self.sent_entries)
+        # Sent entries are only dropped from the queue after they are noted
+        scores += [(entry['score'], entry['name'])
+                   for entry in self.queue.peek() if entry['id'] not in sent]
+        return sorted(scores, reverse=True)[:count]
+
+    def high_score(self):
+        """ Name and score of the best score known. """
+        best = self.top(1)
+        if not best:
+            return "", 0
+        return best[0][1], best[0][0]
+
+    def pending(self):
+        return len(self.queue)
+
+    def run(self):
+        """ Worker thread: send queued scores in batches, and refresh the
+            cached top scores when asked to, backing off on failures. """
+        while True:
+            with self.lock:
+                while not self.closed and not (
+                        (len(self.queue) or self.refresh_wanted) and
+                        time.monotonic() >= self.retry_at):
+                    wait = self.retry_at - time.monotonic()
+                    self.lock.wait(wait if wait > 0 else None)
+                if self.closed:
+                    return
+                batch = self.queue.peek(self.batch_size)
+                refresh = self.refresh_wanted
+
+            try:
+                if batch:
+                    self.send(batch)
+                elif refresh:
+                    self.refresh()
+            except (OSError, http.client.HTTPException, ValueError):
+                with self.lock:
+                    self.failures += 1
+                    self.retry_at = time.monotonic() + self.retry_delay
+                    self.retry_delay = min(self.retry_delay * 2,
+                                           MAX_RETRY_DELAY)
+            else:
+                with self.lock:
+                    self.retry_delay = RETRY_DELAY
+
+    def send(self, batch):
+        status, _answer = self.connection.request('POST', '/scores',
+                                                  {'scores': batch})
+        if status != 200:
+            raise http.client.HTTPException("scores refused: {}".format(
+                status))
+        with self.lock:
+            for entry in batch:
+                self.sent_entries[entry['id']] = (entry['score'],
+                                                  entry['name'])
+            best = sorted(self.sent_entries.items(), key=lambda item: item[1],
+                          reverse=True)
+            self.sent_entries = dict(best[:TOP_COUNT])
+        self.queue.remove({entry['id'] for entry in batch})
+        with self.lock:
+            self.batches += 1
+            self.sent += len(batch)
+            # The top scores may have changed, they are fetched again once
+            # the queue is empty
+            self.refresh_wanted = True
+
+    def refresh(self):
+        status, answer = self.connection.request(
+            'GET', '/top?count={}'.format(TOP_COUNT))
+        if status != 200:
+            raise http.client.HTTPException("no top scores: {}".format(
+                status))
+        with self.lock:
+            self.cached = [(score, name) for score, name in answer['scores']]
+            self.cached_at = time.monotonic()
+            self.sent_entries = {}
+            self.refresh_wanted = False
+
+    def flush(self, timeout):
+        """ Wait up to a timeout for the queued scores to be sent. Return
+            True if they were. """
+        end = time.monotonic() + timeout
+        while self.pending():
+            if time.monotonic() >= end:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def close(self):
+        """ Stop the worker, what is still queued is sent next time. A
+            request still in flight is left to the worker, which is a
+            daemon, rather than waited on. """
+        with self.lock:
+            self.closed = True
+            self.lock.notify()
+        self.worker.join(CLOSE_TIMEOUT)
+        if not self.worker.is_alive():
+            self.connection.close()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """ Requests to the stub server, over persistent connections. """
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def answer(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        server = self.server
+        address = urlparse(self.path)
+        if address.path != '/top':
+            self.answer(404, {'error': 'not found'})
+            return
+        count = int(parse_qs(address.query).get('count', ['10'])[0])
+        time.sleep(server.delay)
+        with server.lock:
+            server.requests += 1
+            scores = sorted(server.scores.values(), reverse=True)[:count]
+        self.answer(200, {'scores': scores})
+
+    def do_POST(self):
+        server = self.server
+        if self.path != '/scores':
+            self.answer(404, {'error': 'not found'})
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            entries = json.loads(self.rfile.read(length))['scores']
+        except (ValueError, KeyError):
+            self.answer(400, {'error': 'bad request'})
+            return
+        time.sleep(server.delay)
+        with server.lock:
+            server.requests += 1
+            for entry in entries:
+                server.scores[entry['id']] = (int(entry['score']),
+                                              str(entry['name']))
+        self.answer(200, {'accepted': len(entries)})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(ThreadingHTTPServer):
+    """ Leaderboard server that keeps its scores in memory, with a delay
+        added to every request to stand in for the network. """
+    daemon_threads = True
+
+    def __init__(self, port=0, delay=0.0):
+        super().__init__(('127.0.0.1', port), StubHandler)
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.scores = {}
+
+        # Metrics
+        self.requests = 0
+        self.connections = 0
+
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.server_address[1])
+
+    def start(self):
+        """ Serve on a thread of its own. """
+        thread = threading.Thread(target=self.serve_forever,
+                                  name="stub server", daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+# Submit scores from a number of clients at once against the stub server,
+# each way, and check that scores made while it is down reach it later
+def benchmark(clients=4, scores=250, delay=0.002):
+    import shutil
+    import socket
+    import tempfile
+
+    directory = tempfile.mkdtemp()
+    try:
+        print("{} clients submitting {} scores each, {:.0f} ms per "
+              "request".format(clients, scores, delay * 1000))
+
+        # One request and connection per score, as a naive client would
+        server = StubServer(delay=delay)
+        server.start()
+        start = time.perf_counter()
+
+        def naive(client):
+            address = urlparse(server.url())
+            for i in range(scores):
+                connection = http.client.HTTPConnection(address.hostname,
+                                                        address.port)
+                body = json.dumps({'scores': [
+                    {'id': uuid.uuid4().hex, 'name': 'naive',
+                     'score': i}]}).encode()
+                connection.request('POST', '/scores', body)
+                connection.getresponse().read()
+                connection.close()
+
+        threads = [threading.Thread(target=naive, args=(client,))
+                   for client in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        print("{:<22}{:>8.2f} s {:>6} requests {:>6} connections".format(
+            "connection per score", elapsed, server.requests,
+            server.connections))
+        server.stop()
+
+        # Backends batching over a connection kept open, the game thread
+        # only queues. Submitting is timed on its own, it is what the game
+        # waits for.
+        server = StubServer(delay=delay)
+        server.start()
+        backends = [RemoteBackend(server.url(), os.path.join(
+            directory, 'queue{}.jsonl'.format(client)))
+            for client in range(clients)]
+        start = time.perf_counter()
+        submit_time = 0.0
+        for i in range(scores):
+            for backend in backends:
+                submitted = time.perf_counter()
+                backend.submit('batched', i)
+                backend.top()
+                submit_time += time.perf_counter() - submitted
+        for backend in backends:
+            backend.flush(60)
+        elapsed = time.perf_counter() - start
+        print("{:<22}{:>8.2f} s {:>6} requests {:>6} connections".format(
+            "batched, kept open", elapsed, server.requests,
+            server.connections))
+        print("game thread: {:.0f} us per submit and top".format(
+            submit_time * 1e6 / (scores * clients)))
+        for backend in backends:
+            backend.close()
+        server.stop()
+
+        # Scores made while the server is down wait on disk, and are sent
+        # once it is up again, even by a client started afresh
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            port = probe.getsockname()[1]
+        queue_file = os.path.join(directory, 'offline.jsonl')
+        backend = RemoteBackend("http://127.0.0.1:{}".format(port),
+                                queue_file)
+        for i in range(20):
+            backend.submit('offline', i)
+        time.sleep(0.2)
+        backend.close()
+        queued = len(OfflineQueue(queue_file).entries)
+
+        server = StubServer(port)
+        server.start()
+        backend = RemoteBackend(server.url(), queue_file)
+        drained = backend.flush(10)
+        backend.close()
+        print("offline: {} queued while down, {} on the server once up, "
+              "queue {}".format(queued, len(server.scores),
+                                "drained" if drained else "NOT drained"))
+        server.stop()
+    finally:
+        shutil.rmtree(directory)
+
+
+def main():
+    """ Parse the command line and serve or benchmark. """
+    parser = argparse.ArgumentParser(description="Project S leaderboard")
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve = commands.add_parser('serve')
+    serve.add_argument('--port', type=int, default=8765)
+    serve.add_argument('--delay', type=float, default=0.0)
+    commands.add_parser('bench')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        server = StubServer(args.port, args.delay)
+        print("Serving a leaderboard on {}".format(server.url()))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.server_close()
+    else:
+        benchmark()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
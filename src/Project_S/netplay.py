@@ -0,0 +1,516 @@
+'''
+@description: Two player co-op over the network, kept in lockstep. Each
+              machine runs the whole game with two spaceships, and the
+              only thing sent between them is the input of the local
+              player for every tick: left, right and fire, one byte.
+
+              Both games start from the same seed for the game rng and
+              run on a tick clock instead of the wall clock, so given the
+              same inputs they play out the same way. A tick is only run
+              once the input of both players for it is known. Local input
+              is scheduled a few ticks ahead (the input delay), so that
+              normally the input of the peer arrives before it is needed.
+
+              Every packet carries the inputs the peer has not yet
+              acknowledged, so lost packets are made up for by the next
+              one. Every so often the games hash their state and swap the
+              hashes, a mismatch means they have drifted apart and play
+              stops with a DesyncError.
+
+@instruction: On each machine, with the same seed and the address of the
+              other machine:
+
+                  python netplay.py --player 0 --port 5000 \\
+                                    --peer 192.168.1.11:5000 --seed 42
+                  python netplay.py --player 1 --port 5000 \\
+                                    --peer 192.168.1.10:5000 --seed 42
+
+              To play both sides on this machine over loopback, with bots
+              for players and simulated latency and packet loss:
+
+                  python netplay.py --loopback --latency 40 --loss 0.1
+'''
+import argparse
+import os
+import random
+import socket
+import struct
+import sys
+import time
+import zlib
+
+import pygame
+
+import Project_S_Game as game_module
+from Project_S_Game import Game, HeldKeys, FPS, SCREEN_WIDTH, SCREEN_HEIGHT
+
+# Input bits, one byte per player per tick
+LEFT = 1
+RIGHT = 2
+FIRE = 4
+
+# Ticks between local input and the tick it is played on
+INPUT_DELAY = 3
+
+# Ticks between state hash checks, and the number of ticks a hash is sent
+# along with the inputs after it was taken
+HASH_INTERVAL = 30
+HASH_RESEND = 8
+
+# Packet header: tick the sender needs next, first tick of the inputs that
+# follow and their count. The top bit of the count says a state hash of
+# tick and crc follows the inputs.
+HEADER = struct.Struct('<IIB')
+CHECK = struct.Struct('<II')
+HAS_CHECK = 0x80
+MAX_INPUTS = 0x7f
+
+# Seconds to keep answering the peer once our game has ended
+LINGER = 2.0
+
+
+class DesyncError(Exception):
+    """ The two games no longer agree on the state of play. """
+    def __init__(self, tick, local, remote):
+        super().__init__("Games out of sync at tick {}: {:08x} != {:08x}"
+                         .format(tick, local, remote))
+        self.tick = tick
+
+
+class KeyboardInput(object):
+    """ Input of the player at this keyboard. Fire is sampled from key
+        presses, so a press is not lost while the game waits on the
+        peer. """
+    def __init__(self):
+        self.fire = False
+        self.quit = False
+
+    def handle_events(self):
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                self.quit = True
+            if event.type == pygame.KEYDOWN and event.key == pygame.K_SPACE:
+                self.fire = True
+
+    def __call__(self):
+        keys = pygame.key.get_pressed()
+        bits = 0
+        if keys[pygame.K_LEFT]:
+            bits |= LEFT
+        if keys[pygame.K_RIGHT]:
+            bits |= RIGHT
+        if self.fire:
+            bits |= FIRE
+            self.fire = False
+        return bits
+
+
+class BotInput(object):
+    """ Random input for loopback play: wanders left and right, firing
+        every so often. """
+    def __init__(self, seed):
+        self.rng = random.Random(seed)
+        self.move = 0
+        self.quit = False
+
+    def handle_events(self):
+        pygame.event.pump()
+
+    def __call__(self):
+        if self.rng.random() < 0.05:
+            self.move = self.rng.choice([0, LEFT, RIGHT])
+        bits = self.move
+        if self.rng.random() < 0.1:
+            bits |= FIRE
+        return bits
+
+
+class Link(object):
+    """ Sends packets over a UDP socket, optionally holding them back by a
+        latency and dropping some, to try out bad networks. """
+    def __init__(self, sock, latency=0, jitter=0, loss=0.0, seed=None):
+        self.sock = sock
+        self.latency = latency / 1000
+        self.jitter = jitter / 1000
+        self.loss = loss
+        self.rng = random.Random(seed)
+        self.queue = []
+
+    def send(self, data, address):
+        if self.loss and self.rng.random() < self.loss:
+            return
+        if not self.latency and not self.jitter:
+            self.transmit(data, address)
+            return
+        delay = self.latency + self.rng.uniform(0, self.jitter)
+        self.queue.append((time.monotonic() + delay, data, address))
+
+    def flush(self):
+        """ Send the held back packets that are due. """
+        now = time.monotonic()
+        due = [item for item in self.queue if item[0] <= now]
+        if due:
+            self.queue = [item for item in self.queue if item[0] > now]
+            for _when, data, address in due:
+                self.transmit(data, address)
+
+    def transmit(self, data, address):
+        try:
+            self.sock.sendto(data, address)
+        except OSError:
+            # Nobody listening yet, the next packet carries the same inputs
+            pass
+
+
+# Pack a packet for the peer
+def encode_packet(ack, first, inputs, check=None):
+    count = len(inputs)
+    if check is not None:
+        count |= HAS_CHECK
+    data = HEADER.pack(ack, first, count) + bytes(inputs)
+    if check is not None:
+        data += CHECK.pack(*check)
+    return data
+
+
+# Unpack a packet from the peer, into ack, first tick, inputs and the state
+# hash check, which is None if there isn't one. Return None for a packet
+# shorter than it says it is.
+def decode_packet(data):
+    if len(data) < HEADER.size:
+        return None
+    ack, first, count = HEADER.unpack_from(data)
+    end = HEADER.size + (count & MAX_INPUTS)
+    if len(data) < end + (CHECK.size if count & HAS_CHECK else 0):
+        return None
+    inputs = data[HEADER.size:end]
+    check = None
+    if count & HAS_CHECK:
+        check = CHECK.unpack_from(data, end)
+    return ack, first, inputs, check
+
+
+# Hash everything the two games must agree on
+def state_hash(game, tick):
+    state = [tick, game.score, len(game.director.queue)]
+    for spaceship in game.spaceships:
+        state += [spaceship.rect.x, spaceship.rect.y, spaceship.health,
+                  spaceship.lives, spaceship.power]
+    for spr in game.all_sprites_list:
+        state += [type(spr).__name__, spr.rect.x, spr.rect.y]
+    state.append(game_module.rng.getstate())
+    return zlib.crc32(repr(state).encode())
+
+
+class Session(object):
+    """ This class represents one side of a lockstep game. Only packets
+        from the address of the peer are taken in. """
+    def __init__(self, sock, peer, player, seed, delay=INPUT_DELAY,
+                 link=None, check_every=HASH_INTERVAL):
+        self.sock = sock
+        self.sock.setblocking(False)
+        # The address packets from the peer come from, resolved once
+        self.peer = socket.getaddrinfo(peer[0], peer[1], sock.family,
+                                       socket.SOCK_DGRAM)[0][4]
+        self.player = player
+        self.delay = delay
+        self.link = link or Link(sock)
+        self.check_every = check_every
+
+        # Inputs by tick, nobody gives any input for the first ticks
+        self.tick = 0
+        self.local = dict.fromkeys(range(delay), 0)
+        self.remote = dict.fromkeys(range(delay), 0)
+        self.next_local = delay
+        self.remote_next = delay
+        self.peer_ack = 0
+
+        # State hashes by tick, ours and the ones the peer sent first
+        self.hashes = {}
+        self.peer_hashes = {}
+        self.last_check = None
+        self.checks = 0
+
+        # Statistics
+        self.stalls = 0
+        self.packets_sent = 0
+        self.packets_received = 0
+        self.packets_dropped = 0
+        self.bytes_sent = 0
+
+        # Both games play on the tick clock from the same seed
+        game_module.get_ticks = self.ticks
+        game_module.rng.seed(seed)
+        self.game = Game(players=2)
+        self.held = [HeldKeys(), HeldKeys()]
+        for spaceship, held in zip(self.game.spaceships, self.held):
+            spaceship.key_state = held
+
+    def ticks(self):
+        """ Game time in milliseconds, on the tick clock. """
+        return self.tick * 1000 // FPS
+
+    def schedule(self, sample):
+        """ Sample the local input for the next tick that needs it, unless
+            it is already as far ahead as the input delay allows. """
+        if self.next_local <= self.tick + self.delay:
+            self.local[self.next_local] = sample()
+            self.next_local += 1
+
+    def send(self):
+        """ Send the peer every input it hasn't acknowledged yet. """
+        first = max(self.peer_ack, self.next_local - MAX_INPUTS)
+        inputs = [self.local[t] for t in range(first, self.next_local)]
+        check = self.last_check
+        if check is not None and self.tick - check[0] > HASH_RESEND:
+            check = None
+        data = encode_packet(self.remote_next, first, inputs, check)
+        self.link.send(data, self.peer)
+        self.link.flush()
+        self.packets_sent += 1
+        self.bytes_sent += len(data)
+
+    def poll(self):
+        """ Take in every packet that has arrived from the peer. """
+        self.link.flush()
+        while True:
+            try:
+                data, address = self.sock.recvfrom(512)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                # The peer isn't up yet and the last packet bounced
+                continue
+            packet = decode_packet(data) if address == self.peer else None
+            if packet is None:
+                # From someone else, or cut short
+                self.packets_dropped += 1
+                continue
+            self.packets_received += 1
+            self.receive(*packet)
+
+    def receive(self, ack, first, inputs, check):
+        self.peer_ack = max(self.peer_ack, ack)
+        for i, bits in enumerate(inputs):
+            if first + i >= self.tick:
+                self.remote.setdefault(first + i, bits)
+        while self.remote_next in self.remote:
+            self.remote_next += 1
+
+        # Drop the inputs both sides are done with
+        for t in [t for t in self.local if t < min(self.peer_ack, self.tick)]:
+            del self.local[t]
+
+        if check is not None:
+            tick, crc = check
+            if tick in self.hashes:
+                self.compare(tick, crc)
+            elif tick >= self.tick:
+                self.peer_hashes[tick] = crc
+
+    def compare(self, tick, crc):
+        local = self.hashes.pop(tick)
+        if local != crc:
+            raise DesyncError(tick, local, crc)
+        self.checks += 1
+
+    def ready(self):
+        """ Whether the inputs of both players for this tick are known. """
+        return self.tick in self.remote and self.tick in self.local
+
+    def run_tick(self):
+        """ Run the game one tick on the inputs of both players. """
+        inputs = [self.local[self.tick], self.remote.pop(self.tick)]
+        if self.player == 1:
+            inputs.reverse()
+
+        game = self.game
+        for spaceship, held, bits in zip(game.spaceships, self.held, inputs):
+            held.held.clear()
+            if bits & LEFT:
+                held.held.add(pygame.K_LEFT)
+            if bits & RIGHT:
+                held.held.add(pygame.K_RIGHT)
+            if bits & FIRE and spaceship.lives > 0:
+                spaceship.shoot(game.all_sprites_list, game.bullet_list)
+        game.enemy_fire()
+        game.run_logic()
+
+        if self.tick % self.check_every == 0:
+            crc = state_hash(game, self.tick)
+            self.hashes[self.tick] = crc
+            self.last_check = (self.tick, crc)
+            if self.tick in self.peer_hashes:
+                self.compare(self.tick, self.peer_hashes.pop(self.tick))
+            for t in [t for t in self.hashes
+                      if t < self.tick - 10 * self.check_every]:
+                del self.hashes[t]
+        self.tick += 1
+
+    def step(self, sample):
+        """ Schedule input, talk to the peer and run a tick if possible.
+            Return True if a tick was run. """
+        self.schedule(sample)
+        self.poll()
+        self.send()
+        if not self.ready():
+            self.stalls += 1
+            return False
+        self.run_tick()
+        return True
+
+    def finish(self):
+        """ Keep the peer supplied with our inputs until it has caught up
+            with us, or gives up. """
+        end = time.monotonic() + LINGER
+        while self.peer_ack < self.tick and time.monotonic() < end:
+            self.poll()
+            self.send()
+            time.sleep(1 / FPS)
+
+    def stats(self):
+        return {'player': self.player,
+                'ticks': self.tick,
+                'score': self.game.score,
+                'stalls': self.stalls,
+                'checks': self.checks,
+                'packets_sent': self.packets_sent,
+                'packets_received': self.packets_received,
+                'packets_dropped': self.packets_dropped,
+                'bytes_sent': self.bytes_sent,
+                'bytes_per_tick': self.bytes_sent / max(self.tick, 1),
+                'final_hash': state_hash(self.game, self.tick)}
+
+
+def play(session, controls, screen=None, max_ticks=None):
+    """ Play a session until the game is over, the window is closed or
+        max_ticks have been run. """
+    clock = pygame.time.Clock()
+    game = session.game
+    while not controls.quit and not game.highscore:
+        if max_ticks is not None and session.tick >= max_ticks:
+            break
+        controls.handle_events()
+        if session.step(controls) and screen is not None and \
+           not game.highscore:
+            game.display_frame(screen)
+        clock.tick(FPS)
+    session.finish()
+
+
+# One side of a loopback game, run in its own process
+def run_peer(player, port, peer_port, seed, delay, latency, jitter, loss,
+             max_ticks, results):
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    os.environ['SDL_AUDIODRIVER'] = 'dummy'
+    pygame.init()
+    screen = pygame.display.set_mode([SCREEN_WIDTH, SCREEN_HEIGHT])
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', port))
+    link = Link(sock, latency, jitter, loss, seed=player)
+    try:
+        session = Session(sock, ('127.0.0.1', peer_port), player, seed,
+                          delay, link)
+        play(session, BotInput(seed + player + 1), screen, max_ticks)
+        results.put(session.stats())
+    except DesyncError as error:
+        results.put({'player': player, 'error': str(error)})
+    finally:
+        sock.close()
+        pygame.quit()
+
+
+# Find a free UDP port on loopback
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def loopback(seed=1, delay=INPUT_DELAY, latency=0, jitter=0, loss=0.0,
+             max_ticks=1200):
+    """ Play both sides of a game on this machine, each in its own process,
+        and check that they ended up in the same state. Return the stats
+        of both players. """
+    import multiprocessing
+
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    ports = [free_port(), free_port()]
+    peers = [context.Process(target=run_peer,
+                             args=(player, ports[player], ports[1 - player],
+                                   seed, delay, latency, jitter, loss,
+                                   max_ticks, results))
+             for player in range(2)]
+    for peer in peers:
+        peer.start()
+    stats = sorted([results.get() for _peer in peers],
+                   key=lambda result: result['player'])
+    for peer in peers:
+        peer.join()
+    return stats
+
+
+def main():
+    """ Parse the command line and play. """
+    parser = argparse.ArgumentParser(description="Project S lockstep co-op")
+    parser.add_argument('--player', type=int, choices=[0, 1], default=0)
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--peer', help="host:port of the other player")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--delay', type=int, default=INPUT_DELAY,
+                        help="input delay in ticks")
+    parser.add_argument('--loopback', action='store_true',
+                        help="play both sides here, with bots")
+    parser.add_argument('--ticks', type=int, default=1200,
+                        help="ticks to play in loopback")
+    parser.add_argument('--latency', type=float, default=0,
+                        help="simulated one way latency in ms")
+    parser.add_argument('--jitter', type=float, default=0,
+                        help="simulated extra random latency in ms")
+    parser.add_argument('--loss', type=float, default=0.0,
+                        help="simulated fraction of packets lost")
+    args = parser.parse_args()
+
+    if args.loopback:
+        stats = loopback(args.seed, args.delay, args.latency, args.jitter,
+                         args.loss, args.ticks)
+        for result in stats:
+            print(result)
+        if any('error' in result for result in stats):
+            return 1
+        if stats[0]['final_hash'] != stats[1]['final_hash']:
+            print("Games ended in different states")
+            return 1
+        print("Games stayed in sync")
+        return 0
+
+    if args.peer is None:
+        parser.error("--peer is needed unless playing --loopback")
+    host, port = args.peer.rsplit(':', 1)
+
+    pygame.init()
+    screen = pygame.display.set_mode([SCREEN_WIDTH, SCREEN_HEIGHT])
+    pygame.display.set_caption("Project S - player {}".format(args.player + 1))
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('', args.port))
+    session = Session(sock, (host, int(port)), args.player, args.seed,
+                      args.delay, Link(sock, args.latency, args.jitter,
+                                       args.loss))
+    try:
+        play(session, KeyboardInput(), screen)
+    except DesyncError as error:
+        print(error)
+        return 1
+    finally:
+        sock.close()
+        pygame.quit()
+    print(session.stats())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
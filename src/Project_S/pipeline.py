@@ -0,0 +1,332 @@
+'''
+@description: Pipelined play. The game is simulated on a thread of its
+              own, while the main thread samples input and draws, so that
+              the simulation of the next tick overlaps with drawing the
+              last one. pygame lets go of the GIL while it blits and flips,
+              so on a machine with more than one core the two run side by
+              side.
+
+              SDL wants its window, events and display drawing on the main
+              thread, so that is where input and drawing stay, and the
+              simulation moves out.
+
+              At the end of every tick the simulation fills in a snapshot
+              of what is on screen: the blits to make, the score, lives
+              and health. Snapshots are double-buffered, the simulation
+              fills the back one while the main thread draws the front one,
+              and they are swapped once the front one is drawn. Snapshots
+              hold references to the sprite images, which are never
+              changed once made, and copies of their rects, so no surface
+              is ever copied.
+
+              The pipeline only runs while the game is being played, the
+              high score prompt and the game over screen are left to the
+              usual loop on the main thread.
+
+@instruction: Play pipelined with:
+
+                  python Project_S_Game.py --pipelined
+
+              Running this file measures throughput and input to flip
+              latency with and without the pipeline, unthrottled:
+
+                  python pipeline.py
+'''
+import sys
+import threading
+import time
+
+import pygame
+
+from controls import INPUT_EVENTS, LatencyHistogram
+
+# GIL switch interval while pipelined, in seconds. The default of 5 ms lets
+# one thread keep the other waiting for most of a frame after a hand over.
+SWITCH_INTERVAL = 0.0005
+
+
+class Snapshot(object):
+    """ This class represents what is needed to draw one frame. """
+    def __init__(self):
+        self.blits = []
+        self.ticks = 0
+        self.score = 0
+        self.players = []
+        # When the input events acted on in it were taken in, for
+        # measuring latency. Kept until the snapshot is drawn.
+        self.stamps = []
+
+
+class SnapshotBuffer(object):
+    """ Two snapshots, the front one for drawing and the back one for the
+        simulation to fill. """
+    def __init__(self):
+        self.snapshots = [Snapshot(), Snapshot()]
+        self.front = 0
+        self.fresh = False
+        self.drawing = False
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def back(self):
+        """ The snapshot the simulation can fill, it is never drawn from
+            until it is published. """
+        return self.snapshots[1 - self.front]
+
+    def publish(self):
+        """ Swap the back snapshot to the front, once the front one is no
+            longer being drawn. """
+        with self.condition:
+            while self.drawing and not self.closed:
+                self.condition.wait()
+            self.front = 1 - self.front
+            self.fresh = True
+            self.condition.notify_all()
+
+    def acquire(self, timeout):
+        """ Wait for a snapshot that hasn't been drawn yet and hold on to
+            it until release. Return None if there is none in time. """
+        with self.condition:
+            if not self.fresh:
+                self.condition.wait(timeout)
+            if not self.fresh:
+                return None
+            self.fresh = False
+            self.drawing = True
+            return self.snapshots[self.front]
+
+    def release(self):
+        with self.condition:
+            self.drawing = False
+            self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+class InputBox(object):
+    """ Input handed from the main thread to the simulation: the keys held,
+        the number of fire presses since the last tick and when the input
+        events were taken in. It stands in for pygame.key.get_pressed for
+        the spaceship on the simulation thread. """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pressed = self.current = pygame.key.get_pressed()
+        self.presses = 0
+        self.stamps = []
+
+    def hold(self, pressed):
+        with self.lock:
+            self.pressed = pressed
+
+    def press(self, stamp):
+        """ A fire press, taken in at the time.perf_counter() stamp. """
+        with self.lock:
+            self.presses += 1
+            self.stamps.append(stamp)
+
+    def stamp(self, stamp):
+        """ Any other input event, only its time is kept. """
+        with self.lock:
+            self.stamps.append(stamp)
+
+    def take(self):
+        """ Take the input for a tick, return the number of fire presses
+            and when the input events were taken in. """
+        with self.lock:
+            self.current = self.pressed
+            presses, stamps = self.presses, self.stamps
+            self.presses = 0
+            self.stamps = []
+        return presses, stamps
+
+    def __call__(self):
+        return self.current
+
+
+class Pipeline(object):
+    """ Plays a game with the simulation on its own thread, for as long as
+        it is being played. Tick times go to the telemetry recorder, and
+        the time from every input event to the flip of the first frame
+        that shows it to a controls.LatencyHistogram, if they are
+        given. """
+    def __init__(self, game, fps, recorder=None, histogram=None):
+        self.game = game
+        self.fps = fps
+        self.recorder = recorder
+        self.histogram = histogram
+        self.buffer = SnapshotBuffer()
+        self.inputs = InputBox()
+        self.running = False
+        self.error = None
+
+        # Measurements
+        self.ticks = 0
+        self.frames = 0
+
+    def playing(self):
+        return not self.game.game_over and not self.game.highscore
+
+    def simulate(self):
+        """ Simulation thread: run ticks and publish a snapshot of each. """
+        game = self.game
+        clock = pygame.time.Clock()
+        try:
+            while self.running and self.playing():
+                started = time.perf_counter()
+                presses, stamps = self.inputs.take()
+                for _i in range(presses):
+                    game.spaceship.shoot(game.all_sprites_list,
+                                         game.bullet_list)
+                game.held_fire()
+                game.enemy_fire()
+                game.run_logic()
+                self.ticks += 1
+
+                snapshot = self.buffer.back()
+                game.take_snapshot(snapshot)
+                # A snapshot that was never drawn still holds its stamps,
+                # they go to the next frame drawn
+                snapshot.stamps += stamps
+                if self.recorder is not None:
+                    self.recorder.frame(time.perf_counter() - started)
+                self.buffer.publish()
+                clock.tick(self.fps)
+        except Exception as error:
+            self.error = error
+        finally:
+            self.buffer.close()
+
+    def sample_input(self):
+        """ Hand the input on to the simulation. Return True if the window
+            was closed. """
+        quit = False
+        now = time.perf_counter()
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                quit = True
+            if event.type == pygame.KEYDOWN and event.key == pygame.K_SPACE:
+                self.inputs.press(now)
+            elif event.type in INPUT_EVENTS:
+                self.inputs.stamp(now)
+        self.inputs.hold(pygame.key.get_pressed())
+        return quit
+
+    def run(self, screen):
+        """ Play until the game is no longer being played. Return True if
+            the window was closed. """
+        game = self.game
+        spaceship = game.spaceship
+        keyboard = spaceship.key_state
+        spaceship.key_state = self.inputs
+
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(SWITCH_INTERVAL)
+        self.running = True
+        thread = threading.Thread(target=self.simulate, name="simulation")
+        thread.start()
+        quit = False
+        try:
+            while not quit:
+                quit = self.sample_input()
+                snapshot = self.buffer.acquire(timeout=0.1)
+                if snapshot is None:
+                    if self.buffer.closed:
+                        break
+                    continue
+                game.draw_snapshot(screen, snapshot)
+                if self.histogram is not None:
+                    now = time.perf_counter()
+                    for stamp in snapshot.stamps:
+                        self.histogram.add(now - stamp)
+                snapshot.stamps = []
+                self.frames += 1
+                self.buffer.release()
+        finally:
+            self.running = False
+            self.buffer.close()
+            thread.join()
+            spaceship.key_state = keyboard
+            sys.setswitchinterval(switch_interval)
+
+        if self.error is not None:
+            raise self.error
+        return quit
+
+
+# Play the same seeded game for a while each way, unthrottled, with fire
+# pressed every few milliseconds, and report frames per second and the time
+# from each press being taken in to the flip of the first frame showing it
+def benchmark(seconds=10.0, press_every=0.005):
+    import os
+
+    from controls import Controls
+
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+    pygame.init()
+    import Project_S_Game as game_module
+
+    screen = pygame.display.set_mode([game_module.SCREEN_WIDTH,
+                                      game_module.SCREEN_HEIGHT])
+
+    def sequential(game, end, histogram):
+        controls = Controls(game_module.FPS)
+        controls.histogram = histogram
+        frames = 0
+        while time.perf_counter() < end and not game.highscore:
+            game.process_events(controls.sample())
+            game.run_logic()
+            if game.highscore:
+                break
+            game.display_frame(screen)
+            controls.flipped()
+            frames += 1
+        return frames
+
+    def pipelined(game, end, histogram):
+        frames = 0
+        while time.perf_counter() < end and not game.highscore:
+            pipeline = Pipeline(game, 0, histogram=histogram)
+            timer = threading.Timer(end - time.perf_counter(),
+                                    pipeline.buffer.close)
+            timer.start()
+            pipeline.run(screen)
+            timer.cancel()
+            frames += pipeline.frames
+        return frames
+
+    def press_fire(stop):
+        while not stop.wait(press_every):
+            pygame.event.post(pygame.event.Event(pygame.KEYDOWN,
+                                                 key=pygame.K_SPACE))
+
+    print("{:.0f} seconds each, unthrottled, fire pressed every {:.0f} ms"
+          .format(seconds, press_every * 1000))
+    for label, play in [("sequential", sequential),
+                        ("pipelined", pipelined)]:
+        frames = 0
+        histogram = LatencyHistogram(step=0.01)
+        stop = threading.Event()
+        presser = threading.Thread(target=press_fire, args=(stop,))
+        presser.start()
+        start = time.perf_counter()
+        end = start + seconds
+        while time.perf_counter() < end:
+            game_module.rng.seed(1)
+            frames += play(game_module.Game(), end, histogram)
+        elapsed = time.perf_counter() - start
+        stop.set()
+        presser.join()
+        pygame.event.clear()
+        print("{:<12}{:>8.0f} frames/s   latency ms: median {:.2f}  "
+              "p95 {:.2f}  ({} presses)".format(
+                  label, frames / elapsed, histogram.percentile(50),
+                  histogram.percentile(95), histogram.count))
+    pygame.quit()
+
+
+if __name__ == "__main__":
+    benchmark()
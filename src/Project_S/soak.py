@@ -0,0 +1,264 @@
+'''
+@description: Soak-test mode for long kiosk sessions. The game is run
+              headless with an autopilot flying the spaceship, and is
+              restarted every time it ends, for as long as requested.
+
+              While it runs, the resident state of the game is sampled at
+              a fixed interval: tracemalloc totals, the size of every
+              sprite group, the number of live Surfaces and the bytes of
+              pixel data they hold, and the number of live mixer Sounds.
+              Once the run is over, every metric is checked for growth
+              without bound and a diff report is printed. The exit status
+              is non-zero if anything leaked.
+
+@instruction: Run from this directory, e.g. for a two hour soak sampling
+              every minute:
+
+                  python soak.py --hours 2 --interval 60
+'''
+import os
+
+# Run without a window or sound card, this must happen before SDL starts
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import argparse
+import gc
+import random
+import sys
+import time
+import tracemalloc
+
+import pygame
+
+from Project_S_Game import Game, HeldKeys, SCREEN_WIDTH, SCREEN_HEIGHT, \
+    Spaceship, rng
+
+# Sprite groups of the game that are sampled
+GROUPS = ['all_sprites_list', 'obstacle_list', 'enemy_list', 'bullet_list',
+          'powerups']
+
+
+class Autopilot(object):
+    """ Flies the spaceship: steers under the closest obstacle, fires
+        regularly and restarts the game whenever it ends. """
+    def __init__(self, seed=None):
+        self.rng = random.Random(seed)
+        self.keys = HeldKeys()
+        self.fire_every = 8
+        self.frame = 0
+        self.games = 0
+
+    def attach(self, game):
+        """ Take over the spaceship controls, needed after every restart
+            since the game re-creates its spaceship. """
+        if game.spaceship.key_state is not self.keys:
+            game.spaceship.key_state = self.keys
+            self.games += 1
+
+    def step(self, game):
+        """ Queue the input for the next frame of the game. """
+        self.frame += 1
+        self.attach(game)
+
+        # Press a key on the game over screen to start the next game
+        if game.game_over:
+            pygame.event.post(pygame.event.Event(pygame.KEYUP,
+                                                 key=pygame.K_SPACE))
+            return
+
+        # Steer towards the lowest obstacle that is on screen
+        ship_x = game.spaceship.rect.centerx
+        target_x = ship_x
+        lowest = -1
+        for obstacle in game.obstacle_list:
+            if 0 <= obstacle.rect.bottom <= SCREEN_HEIGHT and \
+               obstacle.rect.bottom > lowest:
+                lowest = obstacle.rect.bottom
+                target_x = obstacle.rect.centerx
+
+        self.keys.held.clear()
+        if target_x < ship_x - Spaceship.width // 4:
+            self.keys.held.add(pygame.K_LEFT)
+        elif target_x > ship_x + Spaceship.width // 4:
+            self.keys.held.add(pygame.K_RIGHT)
+        elif self.rng.random() < 0.05:
+            self.keys.held.add(self.rng.choice([pygame.K_LEFT,
+                                                pygame.K_RIGHT]))
+
+        if self.frame % self.fire_every == 0:
+            pygame.event.post(pygame.event.Event(pygame.KEYDOWN,
+                                                 key=pygame.K_SPACE))
+
+    def skip_prompt(self, game):
+        """ The high score prompt blocks waiting for a typed name, so end
+            it the same way the prompt does before the frame is drawn. """
+        if game.highscore:
+            game.highscore = False
+            game.game_over = True
+            game.game_over_timer = pygame.time.get_ticks() - 1001
+
+
+# Collect the objects of a type that are referenced from anywhere.
+# Surfaces and Sounds are not tracked by the garbage collector, so they are
+# found through the containers and instances that hold on to them.
+def live_objects(kind):
+    found = {}
+    for obj in gc.get_objects():
+        for ref in gc.get_referents(obj):
+            if isinstance(ref, kind):
+                found[id(ref)] = ref
+    return list(found.values())
+
+
+# Snapshot of the traced heap, leaving out what the soak test allocates
+# itself, such as its samples, which grow with the length of the run
+def heap_snapshot():
+    return tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, __file__),
+        tracemalloc.Filter(False, tracemalloc.__file__)])
+
+
+# Take one sample of everything that should stay bounded, along with the
+# heap snapshot the traced bytes were counted from
+def sample_metrics(game):
+    gc.collect()
+    metrics = {}
+
+    snapshot = heap_snapshot()
+    metrics['tracemalloc_bytes'] = sum(
+        stat.size for stat in snapshot.statistics('filename'))
+
+    for name in GROUPS:
+        metrics['group:' + name] = len(getattr(game, name))
+    metrics['spawn_queue'] = len(game.director.queue)
+
+    surfaces = live_objects(pygame.Surface)
+    metrics['surfaces'] = len(surfaces)
+    metrics['surface_bytes'] = sum(surf.get_pitch() * surf.get_height()
+                                   for surf in surfaces)
+    metrics['sounds'] = len(live_objects(pygame.mixer.Sound))
+    return metrics, snapshot
+
+
+# Find the metrics that grow without bound: split the samples after warm up
+# into quarters and flag a metric when the maximum of every quarter is
+# above the previous one, and the last is clearly above the first
+def find_growth(samples, tolerance=0.1, slack=2):
+    growing = {}
+    if len(samples) < 8:
+        return growing
+
+    size = len(samples) // 4
+    quarters = [samples[i * size:(i + 1) * size] for i in range(4)]
+    for name in samples[0]:
+        peaks = [max(sample[name] for sample in quarter)
+                 for quarter in quarters]
+        rising = all(peaks[i] < peaks[i + 1] for i in range(3))
+        limit = peaks[0] * (1 + tolerance) + slack
+        if rising and peaks[3] > limit:
+            growing[name] = peaks
+    return growing
+
+
+# Print a summary of the run and the details of anything that grew
+def report(samples, growing, baseline, final, out=sys.stdout):
+    print("Soak test: {} samples".format(len(samples)), file=out)
+    print("{:<28}{:>14}{:>14}{:>14}".format("metric", "first", "last",
+                                            "max"), file=out)
+    for name in samples[0]:
+        values = [sample[name] for sample in samples]
+        flag = "  GROWING" if name in growing else ""
+        print("{:<28}{:>14}{:>14}{:>14}{}".format(name, values[0],
+                                                  values[-1], max(values),
+                                                  flag), file=out)
+
+    if not growing:
+        print("No unbounded growth found", file=out)
+        return
+
+    print("", file=out)
+    for name, peaks in growing.items():
+        print("{} peaks per quarter: {}".format(name, peaks), file=out)
+
+    print("", file=out)
+    print("Top allocation growth since warm up:", file=out)
+    for stat in final.compare_to(baseline, 'lineno')[:15]:
+        print("  " + str(stat), file=out)
+
+
+def soak(seconds, interval, warmup, fps=0, seed=None):
+    """ Run the game for the given number of seconds. Return the samples
+        taken after warm up, the metrics that grew, and the tracemalloc
+        snapshots from the end of warm up and the end of the run. pygame
+        and tracemalloc are left running, so that the report is out before
+        they stop. """
+    pygame.init()
+    screen = pygame.display.set_mode([SCREEN_WIDTH, SCREEN_HEIGHT])
+    clock = pygame.time.Clock()
+    tracemalloc.start()
+
+    rng.seed(seed)
+    game = Game()
+    pilot = Autopilot(seed)
+
+    start = time.monotonic()
+    next_sample = start + warmup
+    baseline = None
+    samples = []
+
+    while time.monotonic() - start < seconds:
+        pilot.step(game)
+        if game.process_events():
+            break
+        game.run_logic()
+        pilot.skip_prompt(game)
+        game.display_frame(screen)
+        clock.tick(fps)
+
+        now = time.monotonic()
+        if now >= next_sample:
+            next_sample = now + interval
+            metrics, snapshot = sample_metrics(game)
+            samples.append(metrics)
+            if baseline is None:
+                baseline = snapshot
+
+    final = heap_snapshot()
+
+    print("Played {} games in {} frames".format(pilot.games, pilot.frame))
+    return samples, find_growth(samples), baseline or final, final
+
+
+def main():
+    """ Parse the command line and run the soak test. """
+    parser = argparse.ArgumentParser(description="Project S soak test")
+    parser.add_argument('--hours', type=float, default=1.0)
+    parser.add_argument('--interval', type=float, default=30.0,
+                        help="seconds between samples")
+    parser.add_argument('--warmup', type=float, default=60.0,
+                        help="seconds before the first sample")
+    parser.add_argument('--fps', type=int, default=0,
+                        help="frame rate cap, 0 runs as fast as possible")
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    samples, growing, baseline, final = soak(args.hours * 3600,
+                                             args.interval, args.warmup,
+                                             args.fps, args.seed)
+    if samples:
+        report(samples, growing, baseline, final)
+    else:
+        print("Run too short, no samples taken")
+    sys.stdout.flush()
+
+    # Stop the audio thread before tracing stops, it allocates memory
+    # without holding the GIL
+    pygame.mixer.quit()
+    pygame.quit()
+    tracemalloc.stop()
+    return 1 if growing or not samples else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
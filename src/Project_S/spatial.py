@@ -0,0 +1,300 @@
+'''
+@description: A playfield larger than the screen. The obstacles of a world
+              are kept in a spatial grid, bucketed by the cell their center
+              is in, and the camera follows the player spaceship around it.
+              Each frame the world only looks at the cells around the view:
+
+                  - sprites in or just around the view are updated every
+                    frame, and those in view are drawn
+                  - sprites in the band around that are moved every few
+                    frames, by as far as they would have gone
+                  - sprites further away sleep, and wake to catch up every
+                    SLEEP_INTERVAL frames, a column of cells at a time
+
+              Collisions with obstacles are looked up in the cells around
+              the sprite rather than against every obstacle, so the cost of
+              a frame follows what is around the view rather than how many
+              obstacles the world holds.
+
+@instruction: Play on a world eight screens wide with:
+
+                  python Project_S_Game.py --world
+
+              Running this file compares frame times at a growing world
+              population, with and without culling:
+
+                  python spatial.py
+'''
+import pygame
+
+# Size of a grid cell in pixels
+CELL_SIZE = 128
+
+# How far past the view sprites are updated every frame, and how far past
+# that they are moved every NEAR_INTERVAL frames
+ACTIVE_MARGIN = 96
+NEAR_MARGIN = 480
+
+NEAR_INTERVAL = 4
+SLEEP_INTERVAL = 32
+
+# Sprites are bucketed by their center, so lookups reach this much further
+# to find the sprites that stick out of the cells next to them
+REACH = 64
+
+
+class SpatialGroup(pygame.sprite.Group):
+    """ Sprite group that also keeps its sprites in a grid of cells, by the
+        cell their center is in. Cells keep their sprites in the order they
+        came in, so that going through them is repeatable. The cells of
+        every SLEEP_INTERVAL-th column are also kept together, so that the
+        sleeping ones due to wake are found without going through them
+        all. """
+    def __init__(self, cell_size=CELL_SIZE, *sprites):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.phase_cells = [{} for _i in range(SLEEP_INTERVAL)]
+        self.cell_of = {}
+        super().__init__(*sprites)
+
+    def cell(self, point):
+        return (int(point[0]) // self.cell_size,
+                int(point[1]) // self.cell_size)
+
+    def span(self, rect):
+        """ The first and last cell a rect covers. """
+        left, top = self.cell(rect.topleft)
+        right, bottom = self.cell((rect.right - 1, rect.bottom - 1))
+        return left, top, right, bottom
+
+    def add_internal(self, sprite, *args):
+        super().add_internal(sprite, *args)
+        self.bucket(sprite, self.cell(sprite.rect.center))
+
+    def bucket(self, sprite, cell):
+        bucket = self.cells.get(cell)
+        if bucket is None:
+            bucket = self.cells[cell] = {}
+            self.phase_cells[cell[0] % SLEEP_INTERVAL][cell] = bucket
+        bucket[sprite] = None
+        self.cell_of[sprite] = cell
+
+    def remove_internal(self, sprite):
+        super().remove_internal(sprite)
+        self.unbucket(sprite, self.cell_of.pop(sprite))
+
+    def unbucket(self, sprite, cell):
+        bucket = self.cells[cell]
+        del bucket[sprite]
+        if not bucket:
+            del self.cells[cell]
+            del self.phase_cells[cell[0] % SLEEP_INTERVAL][cell]
+
+    def move(self, sprite):
+        """ Bucket a sprite again after it has moved, if it is still in the
+            group. """
+        cell = self.cell_of.get(sprite)
+        if cell is None:
+            return
+        new_cell = self.cell(sprite.rect.center)
+        if new_cell != cell:
+            self.unbucket(sprite, cell)
+            self.bucket(sprite, new_cell)
+
+    def near(self, rect):
+        """ The sprites that may overlap a rect. """
+        left, top, right, bottom = self.span(rect.inflate(REACH * 2,
+                                                          REACH * 2))
+        cells = self.cells
+        sprites = []
+        for x in range(left, right + 1):
+            for y in range(top, bottom + 1):
+                bucket = cells.get((x, y))
+                if bucket:
+                    sprites.extend(bucket)
+        return sprites
+
+
+# pygame.sprite.spritecollide, looking a spatial group up in the cells
+# around the sprite
+def spritecollide(sprite, group, dokill, collided=None):
+    if not isinstance(group, SpatialGroup):
+        return pygame.sprite.spritecollide(sprite, group, dokill, collided)
+
+    if collided is None:
+        crashed = [spr for spr in group.near(sprite.rect)
+                   if sprite.rect.colliderect(spr.rect)]
+    else:
+        crashed = [spr for spr in group.near(sprite.rect)
+                   if collided(sprite, spr)]
+    if dokill:
+        for spr in crashed:
+            spr.kill()
+    return crashed
+
+
+# pygame.sprite.groupcollide, looking a spatial second group up in the cells
+# around each sprite of the first
+def groupcollide(groupa, groupb, dokilla, dokillb, collided=None):
+    if not isinstance(groupb, SpatialGroup):
+        return pygame.sprite.groupcollide(groupa, groupb, dokilla, dokillb,
+                                          collided)
+
+    crashed = {}
+    for sprite in groupa.sprites():
+        collision = spritecollide(sprite, groupb, dokillb, collided)
+        if collision:
+            crashed[sprite] = collision
+            if dokilla:
+                sprite.kill()
+    return crashed
+
+
+class Camera(object):
+    """ This class represents the part of the world that is on screen. """
+    def __init__(self, view_size, world_size):
+        self.rect = pygame.Rect((0, 0), view_size)
+        self.bounds = pygame.Rect((0, 0), world_size)
+
+    def follow(self, target):
+        """ Center the view on a rect, without leaving the world. """
+        self.rect.center = target.center
+        self.rect.clamp_ip(self.bounds)
+
+
+class World(object):
+    """ This class represents a world larger than the screen. Obstacles
+        are added to its obstacles group, the sprites that stay near the
+        player are left to the game. """
+    def __init__(self, size, view_size, active_margin=ACTIVE_MARGIN,
+                 near_margin=NEAR_MARGIN):
+        self.size = size
+        self.camera = Camera(view_size, size)
+        self.obstacles = SpatialGroup()
+        # Cells looked at around the view are kept to this far out of the
+        # world, past it obstacles only wake with their column
+        self.area = self.obstacles.span(self.camera.bounds.inflate(
+            NEAR_MARGIN * 2, NEAR_MARGIN * 2))
+        self.active_margin = active_margin
+        self.near_margin = near_margin
+        self.frame = 0
+
+        # Obstacles updated this frame, the ones enemies may shoot from
+        self.awake = []
+
+        # Metrics
+        self.drifted = 0
+
+    def update(self, target):
+        """ Follow a rect with the camera, then update the obstacles around
+            the view every frame and the rest now and then. """
+        self.frame += 1
+        self.camera.follow(target)
+        view = self.camera.rect
+        grid = self.obstacles
+        ax0, ay0, ax1, ay1 = grid.span(view.inflate(self.active_margin * 2,
+                                                    self.active_margin * 2))
+        nx0, ny0, nx1, ny1 = grid.span(view.inflate(self.near_margin * 2,
+                                                    self.near_margin * 2))
+        nx0, ny0 = max(nx0, self.area[0]), max(ny0, self.area[1])
+        nx1, ny1 = min(nx1, self.area[2]), min(ny1, self.area[3])
+        near_phase = self.frame % NEAR_INTERVAL
+        sleep_phase = self.frame % SLEEP_INTERVAL
+
+        # Look the cells around the view up band by band, and wake the
+        # column of sleeping cells whose turn it is. Phases go by column, so
+        # that falling into the next cell down doesn't change when a sprite
+        # moves next.
+        cells = grid.cells
+        awake = []
+        near = []
+        for x in range(nx0, nx1 + 1):
+            active_column = ax0 <= x <= ax1
+            near_column = x % NEAR_INTERVAL == near_phase
+            for y in range(ny0, ny1 + 1):
+                bucket = cells.get((x, y))
+                if not bucket:
+                    continue
+                if active_column and ay0 <= y <= ay1:
+                    awake.extend(bucket)
+                elif near_column:
+                    near.extend(bucket)
+        sleeping = []
+        for (x, y), bucket in grid.phase_cells[sleep_phase].items():
+            if not (nx0 <= x <= nx1 and ny0 <= y <= ny1):
+                sleeping.extend(bucket)
+
+        for sprite in awake:
+            sprite.update()
+            grid.move(sprite)
+        for sprites, steps in [(near, NEAR_INTERVAL),
+                               (sleeping, SLEEP_INTERVAL)]:
+            for sprite in sprites:
+                sprite.drift(steps)
+                grid.move(sprite)
+
+        self.awake = awake
+        self.drifted = len(near) + len(sleeping)
+
+    def blits(self, sprites, blit_item):
+        """ Blits for the obstacles in view followed by the sprites given,
+            moved from world to screen coordinates. """
+        view = self.camera.rect
+        dx, dy = -view.x, -view.y
+        items = [blit_item(spr.image, spr.rect.move(dx, dy))
+                 for spr in self.obstacles.near(view)
+                 if view.colliderect(spr.rect)]
+        items += [blit_item(spr.image, spr.rect.move(dx, dy))
+                  for spr in sprites]
+        return items
+
+    def metrics(self):
+        return {'obstacles': len(self.obstacles),
+                'cells': len(self.obstacles.cells),
+                'awake': len(self.awake),
+                'drifted': self.drifted}
+
+
+# Time frames of a game on worlds of a growing size, all as crowded as the
+# screen normally is, with culling and with everything updated and drawn
+# every frame
+def benchmark(frames=300, widths=(1, 4, 16, 64)):
+    import os
+    import time
+
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+    pygame.init()
+    import Project_S_Game as game_module
+
+    screen = pygame.display.set_mode([game_module.SCREEN_WIDTH,
+                                      game_module.SCREEN_HEIGHT])
+    everything = 1 << 20
+
+    print("{} frames each, ms per frame".format(frames))
+    print("{:>8}{:>12}{:>12}{:>12}".format("screens", "obstacles", "culled",
+                                           "all awake"))
+    for width in widths:
+        size = (game_module.SCREEN_WIDTH * width, game_module.SCREEN_HEIGHT)
+        row = []
+        for margin in [ACTIVE_MARGIN, everything]:
+            game_module.rng.seed(1)
+            game = game_module.Game(world_size=size)
+            game.world.active_margin = game.world.near_margin = margin
+            # Spawn the first wave, and keep the player alive throughout
+            while game.director.queue:
+                game.director.update(game)
+            start = time.perf_counter()
+            for _i in range(frames):
+                game.spaceship.health = 100
+                game.enemy_fire()
+                game.run_logic()
+                game.display_frame(screen)
+            row.append((time.perf_counter() - start) * 1000 / frames)
+        print("{:>8}{:>12}{:>12.2f}{:>12.2f}".format(
+            width, len(game.obstacle_list), *row))
+    pygame.quit()
+
+
+if __name__ == "__main__":
+    benchmark()
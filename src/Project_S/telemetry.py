@@ -0,0 +1,283 @@
+'''
+@description: Session telemetry, for balancing. While the game is played a
+              Recorder notes down what happens: spawns, kills, powerup
+              pickups, damage taken, lives lost and frame times. Every event
+              is one row of fixed-width typed columns, appended to in-memory
+              arrays, which are written out as a chunk file once they are
+              full and when the session closes. Nothing is ever rewritten.
+
+              A chunk file is a small header followed by each column, one
+              after the other, as raw little-endian values. TelemetryLog
+              memory-maps the chunk files and reads the columns as typed
+              memoryviews, so queries over millions of events run without
+              parsing any text. Big-endian machines read byteswapped copies
+              of the columns instead.
+
+@instruction: Record a session with:
+
+                  python Project_S_Game.py --telemetry
+
+              which writes chunk files into telemetry/. Summarize them:
+
+                  python telemetry.py telemetry
+
+              Benchmark recording overhead and query speed:
+
+                  python telemetry.py --bench
+'''
+import array
+import mmap
+import os
+import struct
+import sys
+import time
+from collections import Counter
+
+# Event kinds
+GAME_START = 0
+SPAWN = 1
+KILL = 2
+POWERUP = 3
+DAMAGE = 4
+LIFE_LOST = 5
+FRAME = 6
+
+KINDS = ['game_start', 'spawn', 'kill', 'powerup', 'damage', 'life_lost',
+         'frame']
+
+# What the value column holds for spawns and powerups
+OBSTACLES = ('asteroid', 'debris', 'enemy')
+POWERUPS = ('health', 'gun')
+
+# Columns of an event with their array type codes. The value is the number
+# of players for game_start, the obstacle for spawn, the score for kill, the
+# powerup, the damage, the lives left and the frame time in microseconds.
+COLUMNS = [('tick', 'I'), ('time', 'I'), ('kind', 'B'), ('player', 'b'),
+           ('x', 'h'), ('y', 'h'), ('value', 'i')]
+
+# Chunk file header: magic, version, number of columns, number of events
+HEADER = struct.Struct('<4sHHI')
+MAGIC = b'PSTL'
+VERSION = 1
+
+# Events in a chunk file
+CHUNK_EVENTS = 65536
+
+# Columns start on a multiple of this in a chunk file
+ALIGN = 8
+
+
+# Offset of every column in a chunk with a number of events
+def column_offsets(count):
+    offsets = []
+    offset = HEADER.size
+    for _name, code in COLUMNS:
+        offset = (offset + ALIGN - 1) // ALIGN * ALIGN
+        offsets.append(offset)
+        offset += count * array.array(code).itemsize
+    return offsets
+
+
+class Recorder(object):
+    """ This class records the events of a session into chunk files. """
+    def __init__(self, directory, session=None, chunk_events=CHUNK_EVENTS,
+                 clock=None):
+        self.directory = directory
+        self.session = session or time.strftime('%Y%m%d-%H%M%S')
+        self.chunk_events = chunk_events
+        self.clock = clock or (lambda: 0)
+        self.chunks = 0
+        self.tick = 0
+        os.makedirs(directory, exist_ok=True)
+        self.new_columns()
+
+    def new_columns(self):
+        self.columns = [array.array(code) for _name, code in COLUMNS]
+        (self.ticks, self.times, self.kinds, self.players, self.xs, self.ys,
+         self.values) = self.columns
+
+    def record(self, kind, player=-1, x=0, y=0, value=0):
+        """ Note down an event. """
+        self.ticks.append(self.tick)
+        self.times.append(self.clock())
+        self.kinds.append(kind)
+        self.players.append(player)
+        self.xs.append(int(x))
+        self.ys.append(int(y))
+        self.values.append(int(value))
+        if len(self.kinds) >= self.chunk_events:
+            self.flush()
+
+    def frame(self, seconds):
+        """ Note down the time a frame took and move on to the next. """
+        self.record(FRAME, value=seconds * 1000000)
+        self.tick += 1
+
+    def flush(self):
+        """ Write the events so far out as a chunk file. """
+        count = len(self.kinds)
+        if not count:
+            return
+        name = path_of_chunk(self.directory, self.session, self.chunks)
+        with open(name + '.part', 'wb') as out:
+            out.write(HEADER.pack(MAGIC, VERSION, len(COLUMNS), count))
+            for column, offset in zip(self.columns, column_offsets(count)):
+                out.write(b'\0' * (offset - out.tell()))
+                if sys.byteorder != 'little':
+                    column.byteswap()
+                column.tofile(out)
+        # Readers only ever see whole chunks
+        os.replace(name + '.part', name)
+        self.chunks += 1
+        self.new_columns()
+
+    def close(self):
+        self.flush()
+
+
+# File name of a chunk of a session
+def path_of_chunk(directory, session, index):
+    return os.path.join(directory, '{}-{:05d}.tlm'.format(session, index))
+
+
+class Chunk(object):
+    """ This class represents a memory-mapped chunk file. """
+    def __init__(self, name):
+        with open(name, 'rb') as chunk_file:
+            self.map = mmap.mmap(chunk_file.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+        magic, version, columns, self.count = HEADER.unpack_from(self.map)
+        if magic != MAGIC or version != VERSION or columns != len(COLUMNS):
+            self.map.close()
+            raise ValueError("{} is not a telemetry chunk".format(name))
+
+        view = memoryview(self.map)
+        self.columns = {}
+        for (column, code), offset in zip(COLUMNS,
+                                          column_offsets(self.count)):
+            size = self.count * array.array(code).itemsize
+            if sys.byteorder == 'little':
+                self.columns[column] = view[offset:offset + size].cast(code)
+            else:
+                # Columns are stored little-endian
+                values = array.array(code)
+                with view[offset:offset + size] as raw:
+                    values.frombytes(raw)
+                values.byteswap()
+                self.columns[column] = values
+
+    def close(self):
+        for column in self.columns.values():
+            if isinstance(column, memoryview):
+                column.release()
+        self.columns = {}
+        self.map.close()
+
+
+class TelemetryLog(object):
+    """ This class reads the chunk files of a directory, or of one session
+        in it, for queries. """
+    def __init__(self, directory, session=None):
+        names = sorted(name for name in os.listdir(directory)
+                       if name.endswith('.tlm') and
+                       (session is None or name.startswith(session + '-')))
+        self.chunks = [Chunk(os.path.join(directory, name))
+                       for name in names]
+
+    def __len__(self):
+        return sum(chunk.count for chunk in self.chunks)
+
+    def column(self, name):
+        """ The column of every chunk, in order. """
+        return [chunk.columns[name] for chunk in self.chunks]
+
+    def count_by_kind(self):
+        counts = Counter()
+        for kinds in self.column('kind'):
+            counts.update(kinds)
+        return {KINDS[kind]: count for kind, count in counts.items()}
+
+    def values_of(self, kind):
+        """ The values of every event of a kind. """
+        for kinds, values in zip(self.column('kind'), self.column('value')):
+            for event_kind, value in zip(kinds, values):
+                if event_kind == kind:
+                    yield value
+
+    def summary(self):
+        """ Totals of a log, for balancing. """
+        frames = list(self.values_of(FRAME))
+        spawns = Counter(OBSTACLES[value] for value in self.values_of(SPAWN))
+        powerups = Counter(POWERUPS[value]
+                           for value in self.values_of(POWERUP))
+        result = {'events': len(self),
+                  'counts': self.count_by_kind(),
+                  'spawns': dict(spawns),
+                  'powerups': dict(powerups),
+                  'damage_taken': sum(self.values_of(DAMAGE))}
+        if frames:
+            frames.sort()
+            result['frame_ms_mean'] = sum(frames) / len(frames) / 1000
+            result['frame_ms_p99'] = frames[len(frames) * 99 // 100] / 1000
+        return result
+
+    def close(self):
+        for chunk in self.chunks:
+            chunk.close()
+
+
+# Time recording an event against a frame, and querying a million events
+def benchmark(events=1000000, events_per_frame=10):
+    import random
+    import shutil
+    import tempfile
+
+    directory = tempfile.mkdtemp()
+    try:
+        recorder = Recorder(directory, 'bench')
+        rng = random.Random(1)
+        kinds = [rng.choice([SPAWN, KILL, POWERUP, DAMAGE, LIFE_LOST])
+                 for _i in range(1000)]
+
+        start = time.perf_counter()
+        for i in range(events):
+            recorder.record(kinds[i % 1000], 0, i % 480, i % 600, i % 50)
+        recorder.close()
+        elapsed = time.perf_counter() - start
+        per_event = elapsed / events
+        frame = 1 / 60
+        print("Recording: {:.2f} us per event, {} events per frame is "
+              "{:.3f}% of a 60 fps frame".format(
+                  per_event * 1e6, events_per_frame,
+                  per_event * events_per_frame / frame * 100))
+
+        start = time.perf_counter()
+        log = TelemetryLog(directory)
+        counts = log.count_by_kind()
+        damage = sum(log.values_of(DAMAGE))
+        elapsed = time.perf_counter() - start
+        print("Query over {} events in {} chunks: {:.3f} s "
+              "(counts {}, damage {})".format(len(log), len(log.chunks),
+                                              elapsed, counts, damage))
+        log.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("usage: python telemetry.py DIRECTORY [SESSION] | --bench")
+        return 1
+    if sys.argv[1] == '--bench':
+        benchmark()
+        return 0
+    session = sys.argv[2] if len(sys.argv) > 2 else None
+    log = TelemetryLog(sys.argv[1], session)
+    for key, value in log.summary().items():
+        print("{}: {}".format(key, value))
+    log.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
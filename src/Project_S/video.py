@@ -0,0 +1,410 @@
+'''
+@description: Gameplay video capture. Every frame the game shows is copied
+              into a ring of frame slots in shared memory, and a worker
+              process encodes them from there, either into a numbered
+              sequence of lossless images or, when ffmpeg is installed,
+              into a lossless FFV1 video.
+
+              Slots hold frames in the pixel layout of the screen, so
+              capturing a frame is a single copy of the screen's pixels
+              into a free slot, and handing it over is its slot number on
+              a queue. Any conversion is left to the worker. When
+              the worker falls behind and no slot is free, the frame is
+              dropped and counted rather than holding up the game. Scripted
+              runs can wait for a slot instead, so that they lose nothing.
+              Should the worker fail, or stop answering, the capture raises
+              its error rather than waiting on it. While playing, the game
+              is not stopped for it: the error is reported once, and every
+              frame after is dropped.
+
+@instruction: Capture while playing, as TGA images into capture/:
+
+                  python Project_S_Game.py --capture
+
+              Record a seeded run of the soak test autopilot, here into a
+              video, or into a directory of images if not given a video
+              file name:
+
+                  python video.py record run.mkv --seconds 30 --seed 1
+
+              Measure what capturing costs the game, and how many frames
+              each encoder drops, at full speed or at a given frame rate:
+
+                  python video.py bench
+                  python video.py bench --fps 60
+'''
+import argparse
+import os
+import queue
+import shutil
+import subprocess
+import sys
+import time
+import multiprocessing
+from multiprocessing import shared_memory
+
+import pygame
+
+# Frame slots in the ring
+RING_SLOTS = 8
+
+# ffmpeg names of 32 bit pixel layouts, by their red mask
+FFMPEG_PIXEL_FORMATS = {0xff0000: 'bgr0', 0xff: 'rgb0'}
+
+# Output file names that are encoded as video by ffmpeg
+VIDEO_EXTENSIONS = ('.mkv', '.avi', '.mov')
+
+# Seconds to wait for the worker to start or to finish encoding, and how
+# often to check that it is still running meanwhile
+WORKER_TIMEOUT = 30.0
+POLL_SECONDS = 0.1
+
+
+class FrameSequence(object):
+    """ Writes frames as numbered images into a directory, in a lossless
+        format pygame saves to: png, tga or bmp. """
+    def __init__(self, directory, size, masks, image_format='png'):
+        self.directory = directory
+        self.image = pygame.Surface(size, 0, 32, masks)
+        self.image_format = image_format
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, pixels, number):
+        image_pixels = self.image.get_buffer()
+        memoryview(image_pixels)[:] = pixels
+        # The image stays locked while its buffer is held
+        del image_pixels
+        pygame.image.save(self.image, os.path.join(
+            self.directory, 'frame-{:06d}.{}'.format(number,
+                                                     self.image_format)))
+
+    def close(self):
+        pass
+
+
+class FfmpegVideo(object):
+    """ Writes frames into a lossless FFV1 video through ffmpeg. """
+    def __init__(self, file_name, size, masks, fps):
+        self.process = subprocess.Popen(
+            [shutil.which('ffmpeg'), '-loglevel', 'error', '-y',
+             '-f', 'rawvideo', '-pix_fmt', FFMPEG_PIXEL_FORMATS[masks[0]],
+             '-s', '{}x{}'.format(*size), '-r', str(fps), '-i', '-',
+             '-c:v', 'ffv1', file_name],
+            stdin=subprocess.PIPE)
+
+    def write(self, pixels, number):
+        self.process.stdin.write(pixels)
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+
+# Make the writer for an output, a video file or a directory of images
+def open_output(output, size, masks, fps, image_format):
+    if output.endswith(VIDEO_EXTENSIONS):
+        return FfmpegVideo(output, size, masks, fps)
+    return FrameSequence(output, size, masks, image_format)
+
+
+# Worker process: encode frames from the ring as their slot numbers come
+# in, and hand each slot back once it has been written. Whatever stops it
+# is sent back as an error rather than left for the game to wait on.
+def encode(name, size, masks, output, fps, image_format, filled, free,
+           results):
+    try:
+        ring = shared_memory.SharedMemory(name)
+        frame_bytes = size[0] * size[1] * 4
+        writer = open_output(output, size, masks, fps, image_format)
+        results.put(('ready', None))
+        written = 0
+        busy = 0.0
+        while True:
+            item = filled.get()
+            if item is None:
+                break
+            slot, number = item
+            start = time.perf_counter()
+            pixels = ring.buf[slot * frame_bytes:(slot + 1) * frame_bytes]
+            writer.write(pixels, number)
+            pixels.release()
+            busy += time.perf_counter() - start
+            free.put(slot)
+            written += 1
+        writer.close()
+        ring.close()
+    except Exception as error:
+        results.put(('error', '{}: {}'.format(type(error).__name__,
+                                              error)))
+        return
+    results.put(('stats', {'written': written, 'encode_seconds': busy}))
+
+
+class VideoCapture(object):
+    """ Captures the frames shown on a 32 bit surface, the screen, into
+        shared memory for a worker process to encode. With block, a frame
+        waits for a free slot rather than being dropped. """
+    def __init__(self, output, surface, fps=60, slots=RING_SLOTS,
+                 image_format='tga', block=False):
+        size = surface.get_size()
+        masks = surface.get_masks()
+        if surface.get_bitsize() != 32 or \
+           surface.get_pitch() != size[0] * 4:
+            raise ValueError("only 32 bit surfaces can be captured")
+        if output.endswith(VIDEO_EXTENSIONS):
+            if not shutil.which('ffmpeg'):
+                raise RuntimeError("ffmpeg is needed to encode " + output)
+            if masks[0] not in FFMPEG_PIXEL_FORMATS:
+                raise ValueError("no ffmpeg pixel format for the surface")
+
+        self.output = output
+        self.block = block
+        frame_bytes = size[0] * size[1] * 4
+        self.ring = shared_memory.SharedMemory(create=True,
+                                               size=frame_bytes * slots)
+        self.slots = [self.ring.buf[i * frame_bytes:(i + 1) * frame_bytes]
+                      for i in range(slots)]
+        # Slots not handed to the worker yet, the worker hands them back on
+        # the free queue once written
+        self.spare = list(range(slots))
+
+        context = multiprocessing.get_context('spawn')
+        self.filled = context.Queue()
+        self.free = context.Queue()
+        self.results = context.Queue()
+        self.worker = context.Process(
+            target=encode, name="video encoder",
+            args=(self.ring.name, size, masks, output, fps, image_format,
+                  self.filled, self.free, self.results),
+            daemon=True)
+        self.worker.start()
+        # Starting the worker takes a while, wait so that the first frames
+        # aren't dropped
+        try:
+            self.receive()
+        except RuntimeError:
+            self.release(0)
+            raise
+
+        # Error the worker stopped on, once live capture has given up
+        self.failed = None
+
+        # Measurements
+        self.captured = 0
+        self.dropped = 0
+        self.copy_seconds = 0.0
+
+    def receive(self, timeout=WORKER_TIMEOUT):
+        """ Wait for the next result of the worker. Raise RuntimeError
+            with the error it stopped on if it failed, died or didn't
+            answer in time. """
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                kind, value = self.results.get(timeout=POLL_SECONDS)
+            except queue.Empty:
+                if not self.worker.is_alive() and self.results.empty():
+                    kind, value = 'error', "exited with code {}".format(
+                        self.worker.exitcode)
+                elif time.monotonic() >= deadline:
+                    kind, value = 'error', "no answer in {:.0f} s".format(
+                        timeout)
+                else:
+                    continue
+            if kind == 'error':
+                raise RuntimeError("video encoder failed, " + value)
+            return value
+
+    def take_slot(self):
+        if self.spare:
+            return self.spare.pop()
+        deadline = time.monotonic() + WORKER_TIMEOUT
+        while True:
+            try:
+                if self.block:
+                    return self.free.get(timeout=POLL_SECONDS)
+                return self.free.get_nowait()
+            except queue.Empty:
+                # No slot comes back from a worker that has stopped
+                if not self.worker.is_alive():
+                    self.receive(0)
+                if not self.block:
+                    return None
+                if time.monotonic() >= deadline:
+                    raise RuntimeError("video encoder failed, no frame "
+                                       "written in {:.0f} s".format(
+                                           WORKER_TIMEOUT))
+
+    def frame(self, surface):
+        """ Capture a frame. Return False if it was dropped. Once the
+            worker has failed, a blocking capture raises its error, a live
+            one reports it and drops every frame from then on. """
+        if self.failed is not None:
+            self.dropped += 1
+            return False
+        try:
+            slot = self.take_slot()
+        except RuntimeError as error:
+            if self.block:
+                raise
+            self.failed = str(error)
+            print(self.failed + ", no longer capturing", file=sys.stderr)
+            slot = None
+        if slot is None:
+            self.dropped += 1
+            return False
+        start = time.perf_counter()
+        self.slots[slot][:] = surface.get_buffer()
+        self.copy_seconds += time.perf_counter() - start
+        self.filled.put((slot, self.captured))
+        self.captured += 1
+        return True
+
+    def close(self):
+        """ Wait for the worker to encode what was captured, and return
+            the measurements. Raises RuntimeError if the worker failed. """
+        if self.failed is not None:
+            self.release(0)
+            raise RuntimeError(self.failed)
+        self.filled.put(None)
+        try:
+            stats = self.receive()
+        except RuntimeError:
+            self.release(0)
+            raise
+        self.release()
+
+        shown = self.captured + self.dropped
+        stats.update({'captured': self.captured,
+                      'dropped': self.dropped,
+                      'drop_rate': self.dropped / shown if shown else 0.0,
+                      'copy_us': self.copy_seconds * 1e6 /
+                      max(1, self.captured)})
+        return stats
+
+    def release(self, timeout=WORKER_TIMEOUT):
+        """ Wait for the worker to exit, stop it if it doesn't in time, and
+            free the ring. """
+        self.worker.join(timeout)
+        if self.worker.is_alive():
+            self.worker.terminate()
+            self.worker.join()
+        for slot in self.slots:
+            slot.release()
+        self.slots = []
+        self.ring.close()
+        self.ring.unlink()
+
+
+# Play a seeded game headless with the soak test autopilot for a number of
+# frames, showing each one through the game
+def play_scripted(screen, frames, seed, fps=0):
+    import soak
+
+    clock = pygame.time.Clock()
+    soak.rng.seed(seed)
+    game = soak.Game()
+    pilot = soak.Autopilot(seed)
+    for _i in range(frames):
+        pilot.step(game)
+        if game.process_events():
+            break
+        game.run_logic()
+        pilot.skip_prompt(game)
+        game.display_frame(screen)
+        clock.tick(fps)
+
+
+# Record a seeded scripted run without dropping frames
+def record(output, seconds, seed, image_format, fps=60):
+    pygame.init()
+    import Project_S_Game as game_module
+
+    screen = pygame.display.set_mode([game_module.SCREEN_WIDTH,
+                                      game_module.SCREEN_HEIGHT])
+    capture = VideoCapture(output, screen, fps, image_format=image_format,
+                           block=True)
+    game_module.video_capture = capture
+    try:
+        play_scripted(screen, int(seconds * fps), seed)
+    finally:
+        game_module.video_capture = None
+        stats = capture.close()
+        pygame.quit()
+    print("Recorded {written} frames into {output}".format(output=output,
+                                                           **stats))
+
+
+# Time the frames of a scripted run without capture and with each encoder,
+# and report the copy cost and frames dropped
+def benchmark(frames=600, fps=0, seed=1):
+    import tempfile
+
+    pygame.init()
+    import Project_S_Game as game_module
+
+    screen = pygame.display.set_mode([game_module.SCREEN_WIDTH,
+                                      game_module.SCREEN_HEIGHT])
+    directory = tempfile.mkdtemp()
+    runs = [("no capture", None), ("bmp images", 'bmp'),
+            ("tga images", 'tga'), ("png images", 'png')]
+    if shutil.which('ffmpeg'):
+        runs.append(("ffv1 video", 'mkv'))
+    print("{} frames at {}".format(frames, "{} fps".format(fps) if fps
+                                   else "full speed"))
+    try:
+        for label, image_format in runs:
+            capture = None
+            if image_format == 'mkv':
+                capture = VideoCapture(os.path.join(directory, 'run.mkv'),
+                                       screen)
+            elif image_format is not None:
+                capture = VideoCapture(os.path.join(directory,
+                                                    image_format),
+                                       screen, image_format=image_format)
+            game_module.video_capture = capture
+            start = time.perf_counter()
+            play_scripted(screen, frames, seed, fps)
+            elapsed = time.perf_counter() - start
+            game_module.video_capture = None
+            line = "{:<12}{:>8.2f} ms/frame".format(label,
+                                                    elapsed * 1000 / frames)
+            if capture is not None:
+                stats = capture.close()
+                line += ("   copy {copy_us:.0f} us, {captured} captured, "
+                         "{dropped} dropped, encoding {ms:.1f} ms/frame"
+                         .format(ms=stats['encode_seconds'] * 1000 /
+                                 max(1, stats['written']), **stats))
+            print(line)
+    finally:
+        shutil.rmtree(directory)
+        pygame.quit()
+
+
+def main():
+    """ Parse the command line and record or benchmark. """
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+    parser = argparse.ArgumentParser(description="Project S video capture")
+    commands = parser.add_subparsers(dest='command', required=True)
+    recorder = commands.add_parser('record')
+    recorder.add_argument('output')
+    recorder.add_argument('--seconds', type=float, default=30.0)
+    recorder.add_argument('--seed', type=int, default=1)
+    recorder.add_argument('--format', default='png',
+                          choices=['png', 'tga', 'bmp'])
+    bench = commands.add_parser('bench')
+    bench.add_argument('--frames', type=int, default=600)
+    bench.add_argument('--fps', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        record(args.output, args.seconds, args.seed, args.format)
+    else:
+        benchmark(args.frames, args.fps)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())